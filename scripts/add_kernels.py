@@ -16,7 +16,14 @@ import os
 import subprocess
 import shutil
 import re
-import drmaa
+import numpy as np
+import svm_backend
+
+try:
+    import drmaa
+except (ImportError, OSError), e:
+    # the SVMs can still be trained in process
+    drmaa = None
 
 import pdb
 from svm_job import SVMJob
@@ -31,12 +38,19 @@ CLUSTER_ENVIRONMENT = {'LD_LIBRARY_PATH': '/g/reu09/goldenbe/OpenKernel/kernel/l
                                           ':/data/x86_64/OpenFst/lib/'
                                           ':/g/reu09/goldenbe/OpenKernel/kernel/plugin'}
 
+# strategies of search_weights for combining more than two kernels
+STRATEGIES = ('grid', 'random', 'coordinate')
+
+# scores of the weights of combined kernels
+SCORES = ('alignment', 'accuracy')
+
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%H:%M:%S')
 log = logging.getLogger('add_kernels')
 
 def main():
     usage = """%prog KERNEL1 KERNEL2 SVM_FILE OUTPUT_BASENAME [options]
+       %prog --combine STRATEGY KERNEL1 KERNEL2 [KERNEL3 ...] SVM_FILE OUTPUT_BASENAME
             """
     
     opt_parser = optparse.OptionParser(usage=usage)
@@ -53,9 +67,73 @@ def main():
     opt_parser.add_option("-o", "--leave_one_out", action="store_true",
                        help="Perform leave one out cross validation using "
                        "leave_one_out_svm.py")
+    
+    opt_parser.add_option("-m", "--in_memory", action="store_true", default=False,
+                       help="KERNEL1 and KERNEL2 are LIBSVM precomputed kernel "
+                       "files, such as the N-gram.train files of make_kernels.py "
+                       "-e native. Only their rows of the sentences in SVM_FILE "
+                       "are kept. They are read once and summed in memory for "
+                       "each weight instead of with klsum, and the SVMs are "
+                       "trained on the summed weightX.matrix files.")
+    
+    opt_parser.add_option("-p", "--in_process", action="store_true", default=False,
+                       help="With --in_memory, cross-validate an SVM for each "
+                       "weight and c in this process with svm_backend, "
+                       "instead of submitting svm-train jobs with DRMAA.")
+    
+    opt_parser.add_option("--path", action="store_true", default=False,
+                       help="With --in_process, solve the SVMs of each weight "
+                       "along the regularization path, warm-starting each c "
+                       "from the one before.")
+    opt_parser.add_option("--search", action="store_true", default=False,
+                       help="With --in_process, only cross-validate the c "
+                       "values chosen by an adaptive search for each weight "
+                       "(about 15) instead of all of them.")
+    
+    opt_parser.add_option("--combine", action="store", type="choice",
+                       choices=STRATEGIES, 
+                       help="Search for the weights of any number of LIBSVM "
+                       "precomputed kernel files whose sum scores best (see "
+                       "--score) on the sentences in SVM_FILE, by trying a "
+                       "grid of weights, random weights or by coordinate "
+                       "ascent (%s). Only the kernel rows of those sentences "
+                       "are kept, as with --in_memory." % ', '.join(STRATEGIES))
+    opt_parser.add_option("--score", action="store", type="choice",
+                       choices=SCORES, default='alignment',
+                       help="Score the weights of --combine by the alignment "
+                       "of the summed kernel with the labels, or by the "
+                       "cross-validation accuracy (-v folds, 5 by default) of "
+                       "an SVM trained on it with --c_value, pruning the "
+                       "weights on samples of the sentences (%s). "
+                       "Default: %%default" % ', '.join(SCORES))
+    opt_parser.add_option("--c_value", action="store", type=float, default=1.0,
+                       help="SVM cost of --score accuracy. Default: %default")
+    opt_parser.add_option("--resolution", action="store", type=int, default=10,
+                       help="Number of steps between 0 and 1 of each weight "
+                       "for the grid and coordinate strategies. Default: %default")
+    opt_parser.add_option("--samples", action="store", type=int, default=100,
+                       help="Number of weights to try with the random "
+                       "strategy. Default: %default")
+    opt_parser.add_option("--seed", action="store", type=int, default=None,
+                       help="Seed of the random weights, of the samples of "
+                       "sentences used to prune them and of the "
+                       "cross-validation folds.")
 
     options, arguments = opt_parser.parse_args()
     
+    if options.combine:
+        if len(arguments) < 4:
+            opt_parser.error("You must specify at least two kernels, an SVM "
+                             "file and an output basename")
+        
+        log.setLevel(LOG_LEVELS[options.log_level])
+        combine_kernels(arguments[:-2], arguments[-1], options.combine,
+                        svm_filename=arguments[-2],
+                        resolution=options.resolution, samples=options.samples,
+                        seed=options.seed, score=options.score, 
+                        c=options.c_value, folds=options.cross_validate or 5)
+        return
+    
     
     
     if len(arguments) != 4:
@@ -63,6 +141,17 @@ def main():
     if options.svm_test_file == options.cross_validate == options.leave_one_out == None:
         opt_parser.error("You must either specify cross-validation using -v or"
                          " -l or a test data set using -t")
+    if options.in_process and not (options.in_memory and 
+                                   (options.cross_validate or options.leave_one_out)):
+        opt_parser.error("--in_process needs --in_memory and cross-validation "
+                         "(-v or -o)")
+    if (options.path or options.search) and not options.in_process:
+        opt_parser.error("--path and --search need --in_process")
+    if options.path and options.search:
+        opt_parser.error("--path and --search cannot be combined")
+    if not options.in_process and drmaa is None:
+        opt_parser.error("DRMAA cannot be loaded. Use --in_memory --in_process "
+                         "to train the SVMs in this process.")
     
     kernel1 = arguments[0]
     kernel2 = arguments[1]
@@ -78,9 +167,27 @@ def main():
     log.setLevel(LOG_LEVELS[options.log_level])
     
     weight_range = drange(Decimal('0.0'), Decimal('1.0'), Decimal('0.1'))
+    
+    if options.in_process:
+        data_points = cross_validate_in_process(kernel1, kernel2, weight_range,
+                                                options.cross_validate, 
+                                                svm_filename=svm_train_file,
+                                                path=options.path,
+                                                search=options.search,
+                                                seed=options.seed)
+        save_accuracies(data_points, output_basename)
+        
+        best_point = max(data_points, key=lambda x: x['accuracy'])
+        print 'Best accuracy: %(accuracy)s when c=%(c)s and weight=%(weight2)s' % best_point
+        return
+    
     session = drmaa.Session()
     
-    sum_all_kernels(None, kernel1, kernel2, weight_range, output_basename)
+    if options.in_memory:
+        sum_all_kernels_in_memory(kernel1, kernel2, weight_range, output_basename,
+                                  svm_filename=svm_train_file)
+    else:
+        sum_all_kernels(None, kernel1, kernel2, weight_range, output_basename)
     
     if options.cross_validate:
         cross_val_option = options.cross_validate
@@ -111,16 +218,19 @@ def create_svm_jobs(session, kernel_directory, svmin_path, cross_val=None):
     
     ./weight=0.xx/c=x.xx.svmout
                  /c=x.xx.svmerr
+    
+    Kernels summed in memory (weightX.matrix) are trained as precomputed
+    kernels.
     '''
     
-    c_values = list(drange(Decimal('0.1'), Decimal('8'), Decimal('.1')))
+    c_values = svm_c_values()
     
     svm_train = '/g/reu09/goldenbe/OpenKernel/libsvm-2.82/svm-train'
     
     all_svm_jobs = []
     
     for kernel_filename in os.listdir(kernel_directory):
-        if not kernel_filename.endswith('.kar'):
+        if not kernel_filename.endswith(('.kar', '.matrix')):
             log.debug('found kernel: %s' % kernel_filename)
             continue
         
@@ -140,6 +250,7 @@ def create_svm_jobs(session, kernel_directory, svmin_path, cross_val=None):
             svm_job.kernel_path = kernel_path
             svm_job.cross_validation = cross_val
             svm_job.training_file = svmin_path
+            svm_job.precomputed = kernel_filename.endswith('.matrix')
             svm_job.svmtrain_path = svm_train
             svm_job.output_basename = os.path.join(output_directory, 'c' + str(c))
             
@@ -149,14 +260,77 @@ def create_svm_jobs(session, kernel_directory, svmin_path, cross_val=None):
     
     return all_svm_jobs
 
+def svm_c_values():
+    '''
+    Returns the SVM cost parameters tried for each kernel.
+    '''
+    return list(drange(Decimal('0.1'), Decimal('8'), Decimal('.1')))
+
+def cross_validate_in_process(kernel1, kernel2, weight_range, folds=None, 
+                              c_values=None, backend=None, path=False, 
+                              search=False, seed=None, svm_filename=None):
+    '''
+    Cross-validates an SVM for each weight and c value in this process with
+    svm_backend, summing the two LIBSVM precomputed kernel files in memory
+    (see KernelSum), so that neither the kernels nor their sums are read or
+    written more than once. Every SVM uses the same folds, or leave one out
+    if folds is None. With path, the c values of each weight are solved by
+    svm_backend.regularization_path. With search, only the c values chosen
+    by svm_backend.adaptive_c_search between the smallest and largest of
+    c_values are cross-validated. Returns data points like
+    convert_jobs_to_datapoints. If svm_filename is given, only its sentences
+    are cross-validated, so that the test sentences of N-gram.matrix files
+    are neither trained nor tested on.
+    '''
+    kernel_sum = KernelSum(kernel1, kernel2, svm_filename)
+    columns = np.array(kernel_sum.serials) - 1
+    labels = kernel_sum.labels
+    fold_ids = svm_backend.kernel_folds(labels, folds or len(labels), seed)
+    c_values = c_values or svm_c_values()
+    data_points = []
+    
+    for weight, matrix in kernel_sum.combinations(weight_range):
+        gram = matrix[:, columns]
+        cross_validate = lambda c: svm_backend.cross_validation_accuracy(
+                                       gram, labels, float(c), fold_ids=fold_ids, 
+                                       backend=backend)
+        weight_c_values = c_values
+        
+        if path:
+            accuracies, iterations = svm_backend.regularization_path(gram, labels, 
+                                                                     c_values, 
+                                                                     fold_ids=fold_ids)
+            log.info('weight %s: %i solver iterations' % (weight, iterations))
+        elif search:
+            scores = svm_backend.adaptive_c_search(cross_validate, 
+                                                   float(min(c_values)), 
+                                                   float(max(c_values)))[2]
+            weight_c_values = sorted(scores)
+            accuracies = [scores[c] for c in weight_c_values]
+            log.info('weight %s: searched %i values of c' % (weight, len(scores)))
+        else:
+            accuracies = [cross_validate(c) for c in c_values]
+        
+        for c, accuracy in zip(weight_c_values, accuracies):
+            log.debug('weight %s, c %s: %.2f%%' % (weight, c, accuracy))
+            
+            data_points.append({'weight1' : 1 - weight,
+                                'weight2' : weight,
+                                'accuracy' : accuracy,
+                                'c' : c})
+    
+    return data_points
+
 def parse_weight_from_kernel_filename(filename):
     '''
     Returns the weight parsed from the kernel filename.
     
     >> parse_weight_from_kernel_filename('weight0.4.kar')
     0.4
+    >> parse_weight_from_kernel_filename('weight0.4.matrix')
+    0.4
     '''
-    regex = re.compile(r'weight(\d*.\d*).kar')
+    regex = re.compile(r'weight(\d*\.\d*)\.(?:kar|matrix)')
     
     return float(regex.findall(filename)[0])
     
@@ -308,6 +482,519 @@ def sum_all_kernels(session, kernel1, kernel2, weight_range, output_folder):
     log.info('summing jobs started. ids: %s' % job_ids)
     session.synchronize(job_ids, drmaa.Session.TIMEOUT_WAIT_FOREVER, False)
 
+def sum_all_kernels_in_memory(kernel1, kernel2, weight_range, output_folder=None,
+                              train=None, svm_filename=None):
+    '''
+    Sums two LIBSVM precomputed kernel files in memory for each weight, as
+    (1 - weight) * kernel1 + weight * kernel2, reading each kernel once. If
+    svm_filename is given, only the rows of its sentences are summed. Each
+    summed matrix is passed to train(weight, kernel_sum, matrix) if it's
+    given, and written to output_folder/weightX.matrix if that's given.
+    Returns a dictionary of weight -> what train returned.
+    '''
+    kernel_sum = KernelSum(kernel1, kernel2, svm_filename)
+    results = {}
+    
+    for weight, matrix in kernel_sum.combinations(weight_range):
+        if train:
+            results[weight] = train(weight, kernel_sum, matrix)
+        
+        if output_folder:
+            kernel_sum.write(os.path.join(output_folder, 'weight%s.matrix' % weight), 
+                             matrix)
+    
+    return results
+
+class KernelSum(object):
+    '''
+    Two kernel matrices read from LIBSVM precomputed kernel files (see
+    make_kernels.write_precomputed_kernel) whose weighted sums are computed
+    in memory. The files must have the same sentences in the same order.
+    Since the sum is linear, (1 - w) * K1 + w * K2 = K1 + w * (K2 - K1), so
+    each sum only takes one multiplication and one addition of the matrices.
+    
+    >>> kernel_sum = KernelSum.from_matrices(np.array([[2, 0], [0, 2]]),
+    ...                                      np.array([[1, 1], [1, 1]]))
+    >>> kernel_sum.matrix(0.25).tolist()
+    [[1.75, 0.25], [0.25, 1.75]]
+    >>> [weight for weight, matrix in kernel_sum.combinations([0, 0.5, 1])]
+    [0, 0.5, 1]
+    >>> kernel_sum.restrict([2])
+    >>> kernel_sum.serials, kernel_sum.matrix(0.25).tolist()
+    ([2], [[0.25, 1.75]])
+    '''
+    def __init__(self, kernel1_path, kernel2_path, svm_filename=None):
+        labels, serials, self.kernel1 = make_kernels.read_precomputed_kernel(kernel1_path)
+        labels2, serials2, kernel2 = make_kernels.read_precomputed_kernel(kernel2_path)
+        
+        if (labels, serials) != (labels2, serials2) or self.kernel1.shape != kernel2.shape:
+            raise ValueError('%s and %s are not kernels of the same sentences' % 
+                             (kernel1_path, kernel2_path))
+        
+        self.labels = labels
+        self.serials = serials
+        self.difference = kernel2 - self.kernel1
+        
+        if svm_filename:
+            self.restrict(make_kernels.read_svm_input(svm_filename)[1])
+    
+    @classmethod
+    def from_matrices(cls, kernel1, kernel2, labels=None, serials=None):
+        '''
+        Makes a KernelSum of two kernel matrices that are already in memory.
+        '''
+        kernel_sum = cls.__new__(cls)
+        
+        kernel_sum.kernel1 = np.asarray(kernel1, dtype=float)
+        kernel_sum.difference = np.asarray(kernel2, dtype=float) - kernel_sum.kernel1
+        kernel_sum.labels = labels or ['0'] * len(kernel_sum.kernel1)
+        kernel_sum.serials = serials or range(1, len(kernel_sum.kernel1) + 1)
+        
+        return kernel_sum
+    
+    def restrict(self, serials):
+        '''
+        Keeps only the rows of the given 1-based sentence numbers, in that
+        order, such as the training sentences of an SVM input file. Every
+        column is kept, so that the rows can still be indexed by serial.
+        '''
+        rows = serial_rows(self.serials, serials)
+        
+        self.labels = [self.labels[row] for row in rows]
+        self.serials = list(serials)
+        self.kernel1 = self.kernel1[rows]
+        self.difference = self.difference[rows]
+    
+    def matrix(self, weight):
+        '''
+        Returns (1 - weight) * kernel1 + weight * kernel2.
+        '''
+        matrix = np.multiply(self.difference, float(weight))
+        matrix += self.kernel1
+        
+        return matrix
+    
+    def combinations(self, weight_range):
+        '''
+        Yields (weight, summed matrix) for each weight, computing each matrix
+        only when it's asked for.
+        '''
+        for weight in weight_range:
+            yield weight, self.matrix(weight)
+    
+    def write(self, kernel_filename, matrix):
+        '''
+        Writes a summed matrix as a LIBSVM precomputed kernel file.
+        '''
+        log.info('writing %s' % kernel_filename)
+        make_kernels.write_precomputed_kernel(matrix, self.labels, self.serials,
+                                              kernel_filename, 
+                                              rows=range(len(self.serials)))
+
+def combine_kernels(kernel_paths, output_basename, strategy, resolution=10, 
+                    samples=100, seed=None, score='alignment', c=1.0, folds=5,
+                    svm_filename=None):
+    '''
+    Searches for the best weights of any number of LIBSVM precomputed kernel
+    files with search_weights, scoring them by their alignment or by the
+    cross-validation accuracy of an SVM with cost c (see
+    KernelCombination.accuracy). If svm_filename is given, only its
+    sentences are scored, so that the test sentences of N-gram.matrix files
+    don't choose the weights. Saves every weighting tried and its score to
+    combinations.tsv in the output_basename folder, and writes the sum with
+    the best weights to best.matrix. Returns the best (score, weights).
+    '''
+    if not os.path.exists(output_basename):
+        os.makedirs(output_basename)
+    
+    combination = KernelCombination(kernel_paths, seed=seed, 
+                                    svm_filename=svm_filename)
+    
+    if score == 'accuracy':
+        score_function = lambda weights, size: combination.accuracy(weights, size, 
+                                                                    c, folds)
+    elif score == 'alignment':
+        score_function = None
+    else:
+        raise ValueError('unknown score %r' % score)
+    
+    ranked = search_weights(combination, strategy, resolution=resolution,
+                            samples=samples, seed=seed, score=score_function)
+    
+    output = open(os.path.join(output_basename, 'combinations.tsv'), 'w')
+    output.write('\t'.join([os.path.basename(path) for path in kernel_paths] + 
+                           [score]) + '\n')
+    
+    for weights_score, weights in ranked:
+        output.write('\t'.join(['%.4f' % weight for weight in weights] + 
+                               ['%.6f' % weights_score]) + '\n')
+    
+    output.close()
+    
+    best_score, best_weights = ranked[0]
+    combination.write(os.path.join(output_basename, 'best.matrix'), best_weights)
+    
+    print 'Best %s: %.6f with weights %s' % (score, best_score, 
+            ', '.join(['%.4f' % weight for weight in best_weights]))
+    
+    return ranked[0]
+
+def serial_rows(kernel_serials, serials):
+    '''
+    Returns the index in kernel_serials, the sentences of a kernel's rows,
+    of each of the given 1-based sentence numbers. Raises a ValueError if
+    some of them aren't there.
+    
+    >>> serial_rows([3, 1, 2], [2, 3])
+    [2, 0]
+    >>> serial_rows([3, 1, 2], [4])
+    Traceback (most recent call last):
+        ...
+    ValueError: sentences 4 are not in the kernels
+    '''
+    rows_by_serial = dict((serial, row) for row, serial in enumerate(kernel_serials))
+    missing = [serial for serial in serials if serial not in rows_by_serial]
+    
+    if missing:
+        raise ValueError('sentences %s are not in the kernels' % 
+                         ', '.join([str(serial) for serial in missing[:10]]))
+    
+    return [rows_by_serial[serial] for serial in serials]
+
+class KernelCombination(object):
+    '''
+    Any number of kernel matrices of the same sentences, read once from
+    LIBSVM precomputed kernel files, whose weighted sums are scored by
+    their alignment with the labels (see alignment) or by the
+    cross-validation accuracy of an SVM (see accuracy). If an svm_filename
+    is given, only the rows of its sentences are kept.
+    
+    The alignment of a sum of kernels only depends on the inner products
+    of the kernels with the labels and with each other, which are computed
+    once, so scoring a weighting afterwards doesn't touch the matrices at
+    all.
+    
+    >>> combination = KernelCombination.from_matrices(
+    ...     [np.array([[1, 1, 0], [1, 1, 0], [0, 0, 1]]), np.ones((3, 3))], 
+    ...     ['a', 'a', 'b'])
+    >>> round(combination.alignment((1, 0)), 4), round(combination.alignment((0, 1)), 4)
+    (0.7454, 0.1111)
+    >>> combination.matrix((0.5, 0.5)).tolist()
+    [[1.0, 1.0, 0.5], [1.0, 1.0, 0.5], [0.5, 0.5, 1.0]]
+    '''
+    def __init__(self, kernel_paths, seed=None, svm_filename=None):
+        kernels = []
+        
+        for path in kernel_paths:
+            labels, serials, kernel = make_kernels.read_precomputed_kernel(path)
+            
+            if kernels and ((labels, serials) != (self.labels, self.serials) or 
+                            kernel.shape != kernels[0].shape):
+                raise ValueError('%s and %s are not kernels of the same '
+                                 'sentences' % (kernel_paths[0], path))
+            
+            self.labels = labels
+            self.serials = serials
+            kernels.append(kernel)
+        
+        if svm_filename:
+            # only keep the rows of the sentences in the SVM file
+            serials = make_kernels.read_svm_input(svm_filename)[1]
+            rows = serial_rows(self.serials, serials)
+            
+            self.labels = [self.labels[row] for row in rows]
+            self.serials = serials
+            kernels = [kernel[rows] for kernel in kernels]
+        
+        self.setup(kernels, seed)
+    
+    @classmethod
+    def from_matrices(cls, kernels, labels, serials=None, seed=None):
+        '''
+        Makes a KernelCombination of square kernel matrices already in memory.
+        '''
+        combination = cls.__new__(cls)
+        
+        combination.labels = list(labels)
+        combination.serials = serials or range(1, len(labels) + 1)
+        combination.setup(kernels, seed)
+        
+        return combination
+    
+    def setup(self, kernels, seed=None):
+        '''
+        Stacks the kernels and orders the sentences randomly for sampling.
+        '''
+        self.kernels = np.array(kernels, dtype=float)
+        self.columns = np.array(self.serials) - 1
+        self.seed = seed
+        self.order = np.random.RandomState(seed).permutation(len(self.serials))
+        self.alignment_terms = {}
+        self.fold_ids = {}
+    
+    def __len__(self):
+        return len(self.kernels)
+    
+    def matrix(self, weights):
+        '''
+        Returns the weighted sum of the kernels.
+        '''
+        return np.tensordot(np.asarray(weights, dtype=float), self.kernels, axes=1)
+    
+    def terms(self, size=None):
+        '''
+        Returns the inner products <K_i, Y> of each kernel with the target
+        matrix Y and <K_i, K_j> of each pair of kernels over the first size
+        sentences in self.order (all of them by default), where Y is 1 for a
+        pair of sentences with the same label and -1 / (number of labels - 1)
+        otherwise. They're cached for each size.
+        '''
+        size = size or len(self.serials)
+        
+        if size not in self.alignment_terms:
+            rows = np.sort(self.order[:size])
+            labels = np.array(self.labels)[rows]
+            kernels = self.kernels[:, rows][:, :, self.columns[rows]]
+            kernels = kernels.reshape(len(self.kernels), -1)
+            
+            label_count = max(len(set(self.labels)) - 1, 1)
+            target = np.where(labels[:, None] == labels[None, :], 1.0, -1.0 / label_count)
+            
+            self.alignment_terms[size] = (np.dot(kernels, target.ravel()),
+                                          np.dot(kernels, kernels.T),
+                                          np.sqrt((target ** 2).sum()))
+        
+        return self.alignment_terms[size]
+    
+    def alignment(self, weights, size=None):
+        '''
+        Returns the kernel-target alignment <K, Y> / (|K| |Y|) of the
+        weighted sum K of the kernels, over the first size sentences in
+        self.order (see terms).
+        '''
+        target_products, kernel_products, target_norm = self.terms(size)
+        weights = np.asarray(weights, dtype=float)
+        norm = np.sqrt(max(np.dot(weights, np.dot(kernel_products, weights)), 0))
+        
+        if norm == 0:
+            return 0.0
+        
+        return float(np.dot(weights, target_products) / (norm * target_norm))
+    
+    def accuracy(self, weights, size=None, c=1.0, folds=5, backend=None):
+        '''
+        Returns the cross-validation accuracy (%) of an SVM with cost c
+        trained on the weighted sum of the kernels, over the first size
+        sentences in self.order (all of them by default). The folds of each
+        size are the same for every weighting.
+        '''
+        size = size or len(self.serials)
+        rows = np.sort(self.order[:size])
+        labels = np.array(self.labels)[rows]
+        
+        if (size, folds) not in self.fold_ids:
+            self.fold_ids[(size, folds)] = svm_backend.kernel_folds(labels, folds, 
+                                                                    self.seed)
+        
+        kernels = self.kernels[:, rows][:, :, self.columns[rows]]
+        gram = np.tensordot(np.asarray(weights, dtype=float), kernels, axes=1)
+        
+        return svm_backend.cross_validation_accuracy(gram, labels, c, 
+                                                     fold_ids=self.fold_ids[(size, folds)], 
+                                                     backend=backend)
+    
+    def write(self, kernel_filename, weights):
+        '''
+        Writes the weighted sum of the kernels as a LIBSVM precomputed kernel
+        file.
+        '''
+        log.info('writing %s' % kernel_filename)
+        make_kernels.write_precomputed_kernel(self.matrix(weights), self.labels, 
+                                              self.serials, kernel_filename, 
+                                              rows=range(len(self.serials)))
+
+def search_weights(combination, strategy='coordinate', resolution=10, samples=100,
+                   seed=None, score=None):
+    '''
+    Searches the weights (non-negative and summing to 1) of a
+    KernelCombination for the best score, by default its alignment. The
+    strategies are:
+    
+    grid: every weighting whose weights are multiples of 1 / resolution
+    random: samples weightings drawn uniformly from the simplex, and each
+            kernel on its own
+    coordinate: from equal weights, moves each weight in turn to the
+                multiple of 1 / resolution that scores best, until no move
+                improves the score
+    
+    If a score is given, such as the combination's accuracy, the weightings
+    are pruned by successive_halving, so that most are only scored on a
+    sample of the sentences. score(weights, size) must score weights on the
+    first size sentences of the combination's random order. Alignments are
+    always scored on all of the sentences: once its terms are computed, an
+    alignment costs the same on any sample. Returns the (score, weights)
+    pairs scored on all of the sentences, best first.
+    
+    >>> a, b = np.array([1, 1, 0, 0]), np.array([0, 0, 1, 1])
+    >>> combination = KernelCombination.from_matrices(
+    ...     [np.outer(a, a), np.outer(b, b), np.ones((4, 4))], ['a', 'a', 'b', 'b'])
+    >>> [(round(score, 4), weights) for score, weights in 
+    ...  search_weights(combination, 'grid', resolution=2)][:2]
+    [(0.7071, (0.5, 0.5, 0.0)), (0.5, (1.0, 0.0, 0.0))]
+    >>> combination.accuracy((0.5, 0.5, 0.0), folds=2), combination.accuracy((0.0, 0.0, 1.0), folds=2)
+    (100.0, 50.0)
+    '''
+    if score:
+        sizes = sample_sizes(len(combination.serials))
+    else:
+        score = combination.alignment
+        sizes = [len(combination.serials)]
+    kernel_count = len(combination)
+    
+    if strategy == 'grid':
+        candidates = list(simplex_grid(kernel_count, resolution))
+    elif strategy == 'random':
+        random = np.random.RandomState(seed)
+        candidates = [tuple(np.eye(kernel_count)[i]) for i in range(kernel_count)]
+        candidates += [tuple(weights) for weights in 
+                       random.dirichlet(np.ones(kernel_count), samples)]
+    elif strategy == 'coordinate':
+        return coordinate_ascent(kernel_count, score, sizes, resolution)
+    else:
+        raise ValueError('unknown strategy %r' % strategy)
+    
+    return successive_halving(candidates, score, sizes)
+
+def coordinate_ascent(kernel_count, score, sizes, resolution=10, max_sweeps=20):
+    '''
+    Starting from equal weights, tries each multiple of 1 / resolution for
+    each weight in turn, scaling the other weights to keep the sum at 1, and
+    moves to the best if it's better. The moves of each weight are pruned by
+    successive_halving. Stops when a sweep over all the weights doesn't
+    improve the score, so each sweep scores about kernel_count * resolution
+    weightings. Returns every (score, weights) pair scored on all of the
+    sentences, best first.
+    '''
+    weights = tuple([1.0 / kernel_count] * kernel_count)
+    scored = {weights: score(weights, sizes[-1])}
+    
+    for sweep in range(max_sweeps):
+        improved = False
+        
+        for kernel in range(kernel_count):
+            candidates = [move_weight(weights, kernel, float(step) / resolution)
+                          for step in range(resolution + 1)]
+            candidates = [candidate for candidate in candidates 
+                          if candidate not in scored]
+            
+            if not candidates:
+                continue
+            
+            ranked = successive_halving(candidates, score, sizes)
+            scored.update([(candidate, candidate_score) 
+                           for candidate_score, candidate in ranked])
+            
+            if ranked[0][0] > scored[weights]:
+                weights = ranked[0][1]
+                improved = True
+        
+        log.debug('sweep %i: %.6f with %s' % (sweep, scored[weights], weights))
+        
+        if not improved:
+            break
+    
+    return sorted([(candidate_score, candidate) for candidate, candidate_score 
+                   in scored.iteritems()], reverse=True)
+
+def move_weight(weights, index, value):
+    '''
+    Sets one weight to value, scaling the others so that they sum to 1.
+    
+    >>> move_weight((0.5, 0.25, 0.25), 0, 0.0)
+    (0.0, 0.5, 0.5)
+    >>> move_weight((1.0, 0.0), 0, 0.5)
+    (0.5, 0.5)
+    '''
+    rest = sum(weights) - weights[index]
+    moved = []
+    
+    for i, weight in enumerate(weights):
+        if i == index:
+            moved.append(value)
+        elif rest > 0:
+            moved.append(round(weight * (1 - value) / rest, 10))
+        else:
+            moved.append(round((1 - value) / (len(weights) - 1), 10))
+    
+    return tuple(moved)
+
+def successive_halving(candidates, score, sizes, keep=0.5):
+    '''
+    Scores the candidate weightings on each sample size in turn, keeping
+    the best fraction (keep) of them for the next, larger, size. Returns the
+    (score, weights) of those scored on the last size, best first.
+    '''
+    remaining = list(candidates)
+    
+    for size in sizes:
+        ranked = sorted([(score(weights, size), weights) for weights in remaining], 
+                        reverse=True)
+        
+        if size == sizes[-1]:
+            break
+        
+        remaining = [weights for weights_score, weights in 
+                     ranked[:max(int(np.ceil(len(ranked) * keep)), 1)]]
+        log.debug('kept %i of %i weightings scored on %i sentences' % 
+                  (len(remaining), len(ranked), size))
+    
+    return ranked
+
+def sample_sizes(count, minimum=100):
+    '''
+    Returns the sample sizes of successive_halving: halving count until it
+    would be less than minimum, smallest first.
+    
+    >>> sample_sizes(966)
+    [120, 241, 483, 966]
+    >>> sample_sizes(50)
+    [50]
+    '''
+    sizes = [count]
+    
+    while sizes[-1] // 2 >= minimum:
+        sizes.append(sizes[-1] // 2)
+    
+    return sizes[::-1]
+
+def simplex_grid(kernel_count, resolution):
+    '''
+    Yields every weighting of kernel_count kernels whose weights are
+    multiples of 1 / resolution summing to 1.
+    
+    >>> list(simplex_grid(3, 2))
+    [(0.0, 0.0, 1.0), (0.0, 0.5, 0.5), (0.0, 1.0, 0.0), (0.5, 0.0, 0.5), (0.5, 0.5, 0.0), (1.0, 0.0, 0.0)]
+    '''
+    if kernel_count == 1:
+        yield (1.0,)
+        return
+    
+    for step in range(resolution + 1):
+        for rest in simplex_grid_steps(kernel_count - 1, resolution - step):
+            yield tuple([float(step) / resolution] + 
+                        [float(steps) / resolution for steps in rest])
+
+def simplex_grid_steps(kernel_count, total):
+    '''
+    Yields every tuple of kernel_count non-negative integers summing to total.
+    '''
+    if kernel_count == 1:
+        yield (total,)
+        return
+    
+    for first in range(total + 1):
+        for rest in simplex_grid_steps(kernel_count - 1, total - first):
+            yield (first,) + rest
 
 def read_accuracies(data_points, filename):
     '''
@@ -337,4 +1024,8 @@ def drange(start, stop, step):
         r += step
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        import doctest
+        doctest.testmod(verbose=False)
+    else:
+        main()
@@ -12,6 +12,11 @@ import optparse
 import logging
 import subprocess
 import os
+import multiprocessing
+import time
+import hashlib
+import cPickle
+import numpy as np
 import pdb
 
 LOG_LEVELS = {'debug': logging.DEBUG,
@@ -20,6 +25,18 @@ LOG_LEVELS = {'debug': logging.DEBUG,
               'error': logging.ERROR,
            'critical': logging.CRITICAL}
 
+# kernel engines: OpenKernel's klngram and kleval, or native_ngram_kernel
+ENGINES = ('openkernel', 'native')
+
+# n-gram orders of the kernels made for each FST type
+ORDERS = (1, 2)
+
+# seconds a kernel task may run before it's failed, e.g. if its worker died
+TASK_TIMEOUT = 24 * 3600
+
+# seconds between checks on the running tasks
+POLL_INTERVAL = 1
+
 logging.basicConfig()
 log = logging.getLogger('make-kernels')
 
@@ -32,23 +49,100 @@ def main():
     #opt_parser.add_option("-l", "--log_level", action="store_true", 
     #                   default='warning', dest="log_level")
     
+    opt_parser.add_option("-e", "--engine", action='store', type='choice',
+                        choices=ENGINES, default='openkernel', dest='engine',
+                        help="Make kernels with OpenKernel's klngram and "
+                        "kleval ('openkernel') or directly from the symbol "
+                        "sequences of unweighted FSTs ('native'), which writes "
+                        "LIBSVM precomputed kernel files. Default: %default")
+    opt_parser.add_option("-o", "--orders", action='store', 
+                        default=','.join(map(str, ORDERS)), dest='orders',
+                        help="Comma separated n-gram orders of the kernels to "
+                        "make for each fstlist. Default: %default")
+    opt_parser.add_option("-j", "--jobs", action='store', type=int,
+                        default=multiprocessing.cpu_count(), dest='jobs',
+                        help="Number of kernel commands to run at once. "
+                        "Default: %default")
+    opt_parser.add_option("-n", "--dry-run", action='store_true', default=False,
+                        dest='dry_run', help="List the kernels that would be "
+                        "made and why, without making them.")
+    opt_parser.add_option("-f", "--force", action='store_true', default=False,
+                        dest='force', help="Make every kernel, even if it is "
+                        "up to date.")
+    opt_parser.add_option("-t", "--timeout", action='store', type=int,
+                        default=TASK_TIMEOUT, dest='timeout',
+                        help="Seconds a kernel command may run with more than "
+                        "one job before it fails. Default: %default")
+    
     options, arguments = opt_parser.parse_args()
     #log.setLevel(LOG_LEVELS[opt_parser.log_level])
     log.setLevel(logging.DEBUG)
     
-    walk_directory(arguments[0])
+    try:
+        orders = parse_orders(options.orders)
+    except ValueError, e:
+        opt_parser.error(str(e))
+    
+    walk_directory(arguments[0], options.engine, orders, options.jobs,
+                   force=options.force, dry_run=options.dry_run, 
+                   timeout=options.timeout)
 
-def walk_directory(top_directory):
+def parse_orders(orders):
+    '''
+    Parses a comma separated list of n-gram orders.
+    
+    >>> parse_orders('1,2, 3')
+    (1, 2, 3)
+    >>> parse_orders('0')
+    Traceback (most recent call last):
+        ...
+    ValueError: n-gram orders must be positive integers, not '0'
+    '''
+    try:
+        parsed = tuple([int(order) for order in orders.split(',')])
+    except ValueError:
+        parsed = ()
+    
+    if not parsed or min(parsed) < 1:
+        raise ValueError('n-gram orders must be positive integers, not %r' % orders)
+    
+    return parsed
+
+def walk_directory(top_directory, engine='openkernel', orders=ORDERS, jobs=1,
+                   force=False, dry_run=False, timeout=TASK_TIMEOUT):
     '''
     Walk through the directories, looking for *.fstlist files. If one is
-    found, creates a 1 and 2-gram kernel and assumes there is a symbol file
-    at *.fstlist/../fsts/symbol_table.tsv
+    found, creates an n-gram kernel of each order and assumes there is a
+    symbol file at *.fstlist/../fsts/symbol_table.tsv. With the native
+    engine, the kernels are made by native_ngram_kernel instead of
+    OpenKernel. Only the kernels that are out of date are made (see
+    KernelStamp), unless force is set. The kernel commands are run by
+    run_task_graph with up to jobs of them at once, each failing after
+    timeout seconds. Returns the names of the tasks that failed. With
+    dry_run, the out of date kernels are printed instead.
+    '''
+    kernels = stale_kernels(find_fstlists(top_directory), engine, orders, force)
+    
+    if dry_run:
+        for fstlist, order, sigma, stamp in kernels:
+            print '%s %i-gram: %s' % (fstlist, order, stamp.reason)
+        
+        return []
+    
+    return run_task_graph(kernel_tasks(kernels, engine), jobs, timeout)
+
+def find_fstlists(top_directory):
+    '''
+    Returns the *.fstlist files under top_directory that have a symbol file
+    at fsts/symbol_table.tsv next to them, paired with that symbol file.
     '''
     top_directory = os.path.realpath(top_directory)
     log.debug('starting walk of %s' % top_directory)
     
+    fstlists = []
+    
     for (dirpath, dirnames, filenames) in os.walk(top_directory):
-        for filename in filenames:
+        for filename in sorted(filenames):
             if filename.endswith('.fstlist'):
                 log.debug('found %s' % filename)
                 symbol_path = os.path.join(dirpath , 'fsts', 'symbol_table.tsv')
@@ -56,18 +150,405 @@ def walk_directory(top_directory):
                 if not os.path.exists(symbol_path):
                     log.error('There is not a symbol file at %s' % symbol_path)
                 else:
-                    log.debug('now in %s' % dirpath)
-                    sigma = determine_alphabet_size(symbol_path)
-                    fstlist = os.path.join(dirpath, filename)
-                    create_ngram_kernel(sigma, 1, fstlist)
-                    create_ngram_kernel(sigma, 2, fstlist)
+                    fstlists.append((os.path.join(dirpath, filename), symbol_path))
+    
+    return fstlists
+
+def stale_kernels(fstlists, engine='openkernel', orders=ORDERS, force=False):
+    '''
+    Returns an (fstlist, order, alphabet size, KernelStamp) tuple for each
+    kernel of the (fstlist, symbol file) pairs that is out of date, or for
+    every kernel if force is set. The alphabet size is None for the native
+    engine, which doesn't need it.
+    '''
+    kernels = []
+    
+    for fstlist, symbol_path in fstlists:
+        sigma = None
+        
+        if engine == 'openkernel':
+            sigma = determine_alphabet_size(symbol_path)
+        
+        dependencies = kernel_dependencies(engine, fstlist, symbol_path)
+        
+        for order in orders:
+            stamp = KernelStamp(engine, order, sigma, fstlist, dependencies)
+            
+            if force:
+                stamp.reason = 'forced'
+            elif stamp.is_up_to_date():
+                log.info('%s %i-gram is up to date' % (fstlist, order))
+                continue
+            
+            log.debug('%s %i-gram is out of date: %s' % (fstlist, order, stamp.reason))
+            kernels.append((fstlist, order, sigma, stamp))
+    
+    return kernels
+
+def kernel_tasks(kernels, engine='openkernel'):
+    '''
+    Returns the task graph (see run_task_graph) that makes each kernel from
+    stale_kernels. With OpenKernel, each kernel is a klngram task followed by
+    a kleval task that depends on it; the native engine makes each kernel in
+    a single task. Once a kernel is made, its stamp is written.
+    
+    >>> tasks = kernel_tasks([('a/a.fstlist', 1, None, None), 
+    ...                       ('a/a.fstlist', 3, None, None)], 'native')
+    >>> sorted(tasks)
+    ['a/a.fstlist 1-gram', 'a/a.fstlist 3-gram']
+    >>> tasks['a/a.fstlist 3-gram'][1:]
+    ((3, 'a/a.fstlist'), ())
+    '''
+    tasks = {}
+    
+    for fstlist, order, sigma, stamp in kernels:
+        name = '%s %i-gram' % (fstlist, order)
+        
+        if engine == 'native':
+            tasks[name] = (native_ngram_kernel_task, (order, fstlist), ())
+            last_task = name
+        else:
+            kernel_path = ngram_kernel_path(order, fstlist)
+            tasks[name] = (run_klngram, (sigma, order, fstlist), ())
+            last_task = name + ' matrix'
+            tasks[last_task] = (compile_kernel, (kernel_path,), (name,))
+        
+        if stamp is not None:
+            tasks[name + ' stamp'] = (write_kernel_stamp, (stamp,), (last_task,))
+    
+    return tasks
+
+def kernel_dependencies(engine, fstlist, symbol_path):
+    '''
+    Returns the files a kernel of the fstlist is made from: the fstlist, the
+    symbol file and the FSTs it lists for OpenKernel, or, for the native
+    engine, the files read by read_label_sequences and the LIBSVM input
+    files read by write_svm_kernel_files.
+    '''
+    fst_paths = [line.strip() for line in open(fstlist) if line.strip() != '']
+    dependencies = [fstlist, symbol_path]
+    
+    if engine == 'openkernel':
+        return dependencies + fst_paths
+    
+    fst_directory = os.path.dirname(symbol_path)
+    text_paths = [os.path.splitext(path)[0] + '.txt' for path in fst_paths]
+    
+    if fst_paths and not os.path.exists(text_paths[0]):
+        text_paths = [os.path.join(os.path.dirname(fst_paths[0]), 'sentences.strings')]
+    
+    svm_paths = [os.path.join(fst_directory, filename) 
+                 for filename, extension in svm_input_files(fst_directory)]
+    
+    return dependencies + text_paths + svm_paths
+
+class KernelStamp(object):
+    '''
+    Records what a kernel was made from in a .stamp file next to it, so that
+    it is only made again when it is out of date, like make: when one of its
+    files is missing, or it was made with another engine or alphabet size,
+    or from other files, or one of those files has changed. A file whose
+    modification time and size match the stamp is taken to be unchanged;
+    otherwise its SHA-1 is compared, so that FSTs written again with the
+    same contents don't make the kernels out of date.
+    '''
+    def __init__(self, engine, order, sigma, fstlist, dependencies):
+        basepath = os.path.join(os.path.dirname(fstlist), '%i-gram' % order)
+        
+        self.path = basepath + '.stamp'
+        self.engine = engine
+        self.order = order
+        self.sigma = sigma
+        self.dependencies = dependencies
+        self.files = None
+        self.reason = None
+        
+        if engine == 'native':
+            fst_directory = os.path.join(os.path.dirname(fstlist), 'fsts')
+            self.targets = ['%s.%s' % (basepath, extension) for filename, extension 
+                            in svm_input_files(fst_directory)]
+        else:
+            self.targets = [basepath + '.kar', basepath + '.matrix.kar']
+    
+    def read(self):
+        '''
+        Returns the contents of the stamp file, or None if there isn't one.
+        '''
+        try:
+            return cPickle.load(open(self.path, 'rb'))
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            return None
+    
+    def fingerprint_files(self, stored_files):
+        '''
+        Sets self.files to the (modification time, size, SHA-1) of each
+        dependency, reusing the SHA-1 of stored_files if the time and size
+        are the same. Raises an OSError if a dependency is missing.
+        '''
+        self.files = {}
+        
+        for path in self.dependencies:
+            stat = os.stat(path)
+            stored = stored_files.get(path)
+            
+            if stored is not None and stored[:2] == (stat.st_mtime, stat.st_size):
+                self.files[path] = stored
+            else:
+                self.files[path] = (stat.st_mtime, stat.st_size, file_sha1(path))
+    
+    def is_up_to_date(self):
+        '''
+        Returns whether the kernel is up to date, setting self.reason to why
+        it isn't.
+        '''
+        stored = self.read() or {}
+        
+        try:
+            self.fingerprint_files(stored.get('files', {}))
+        except OSError, e:
+            self.reason = '%s is missing' % e.filename
+            return False
+        
+        missing = [path for path in self.targets if not os.path.exists(path)]
+        
+        if missing:
+            self.reason = '%s is missing' % missing[0]
+        elif not stored:
+            self.reason = 'there is no stamp at %s' % self.path
+        elif stored['engine'] != self.engine:
+            self.reason = 'it was made with the %s engine' % stored['engine']
+        elif stored['sigma'] != self.sigma:
+            self.reason = 'the alphabet size was %s' % stored['sigma']
+        elif sorted(stored['files']) != sorted(self.files):
+            self.reason = 'the fstlist has different files'
+        else:
+            changed = [path for path in self.dependencies 
+                       if stored['files'][path][2] != self.files[path][2]]
+            
+            if not changed:
+                if stored['files'] != self.files:
+                    # record the new times, so the files aren't hashed again
+                    self.write()
+                
+                return True
+            
+            self.reason = '%s changed' % changed[0]
+            
+            if len(changed) > 1:
+                self.reason += ' (and %i other files)' % (len(changed) - 1)
+        
+        return False
+    
+    def write(self):
+        '''
+        Writes the stamp, with the fingerprints of the dependencies taken
+        before the kernel was made.
+        '''
+        if self.files is None:
+            self.fingerprint_files((self.read() or {}).get('files', {}))
+        
+        temp_path = '%s.%i.tmp' % (self.path, os.getpid())
+        
+        stamp_file = open(temp_path, 'wb')
+        cPickle.dump({'engine' : self.engine,
+                      'order' : self.order,
+                      'sigma' : self.sigma,
+                      'files' : self.files}, stamp_file, cPickle.HIGHEST_PROTOCOL)
+        stamp_file.close()
+        
+        os.rename(temp_path, self.path)
+
+def write_kernel_stamp(stamp):
+    '''
+    Calls KernelStamp.write in a task of run_task_graph.
+    '''
+    stamp.write()
+
+def file_sha1(path):
+    '''
+    Returns the hex SHA-1 digest of a file's contents.
+    '''
+    digest = hashlib.sha1()
+    input_file = open(path, 'rb')
+    
+    for block in iter(lambda: input_file.read(1 << 16), ''):
+        digest.update(block)
+    
+    input_file.close()
+    
+    return digest.hexdigest()
+
+def run_task_graph(tasks, jobs=1, timeout=TASK_TIMEOUT):
+    '''
+    Runs a graph of tasks, a dictionary of name -> (function, arguments,
+    names of the tasks it depends on), on a pool of jobs processes. A task
+    starts once all of its dependencies have finished, and independent
+    tasks run concurrently. If a task raises an exception, or runs on the
+    pool for more than timeout seconds (e.g. because its worker died), the
+    tasks that depend on it are skipped, as are the tasks that depend on a
+    task which isn't in the graph. Returns the names of the tasks that
+    failed or were skipped. Raises a ValueError if the graph has a cycle.
+    
+    >>> run_task_graph({'a': (abs, (-1,), ()), 'b': (int, ('x',), ('a',)),
+    ...                 'c': (abs, (1,), ('b',))})
+    ['b', 'c']
+    >>> run_task_graph({'a': (abs, (-1,), ('b',)), 'b': (abs, (1,), ('a',))})
+    Traceback (most recent call last):
+        ...
+    ValueError: the dependencies of a, b have a cycle
+    '''
+    waiting = dict([(name, tasks[name]) for name in topological_order(tasks)])
+    finished = set()
+    failed = set()
+    # name -> (AsyncResult, start time) of the tasks running on the pool
+    running = {}
+    timed_out = False
+    
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+    
+    while waiting or running:
+        for name in sorted(waiting):
+            function, arguments, dependencies = waiting[name]
+            
+            if not set(dependencies).issubset(tasks):
+                log.error('skipping %s because it depends on unknown tasks %s' % 
+                          (name, ', '.join(sorted(set(dependencies) - set(tasks)))))
+                failed.add(name)
+                del waiting[name]
+            elif failed.intersection(dependencies):
+                log.error('skipping %s because a task it depends on failed' % name)
+                failed.add(name)
+                del waiting[name]
+            elif finished.issuperset(dependencies):
+                del waiting[name]
+                
+                if jobs > 1:
+                    result = pool.apply_async(task_job, ((name, function, arguments),))
+                    running[name] = (result, time.time())
+                else:
+                    error = task_job((name, function, arguments))[1]
+                    
+                    if error is None:
+                        finished.add(name)
+                    else:
+                        failed.add(name)
+        
+        if running and not [name for name in running if running[name][0].ready()]:
+            # wait for the oldest task, rather than spinning
+            oldest = min(running, key=lambda name: running[name][1])
+            running[oldest][0].wait(POLL_INTERVAL)
+        
+        for name in sorted(running):
+            result, started = running[name]
+            
+            try:
+                error = result.get(0)[1]
+            except multiprocessing.TimeoutError:
+                if time.time() - started < timeout:
+                    continue
+                
+                log.error('%s failed: no result after %i seconds' % (name, timeout))
+                error = 'timed out'
+                timed_out = True
+            except Exception, e:
+                log.error('%s failed: %s' % (name, e))
+                error = str(e)
+            
+            del running[name]
+            
+            if error is None:
+                finished.add(name)
+            else:
+                failed.add(name)
+    
+    if jobs > 1:
+        if timed_out:
+            # the workers of timed out tasks may never finish
+            pool.terminate()
+        else:
+            pool.close()
+        
+        pool.join()
+    
+    return sorted(failed)
+
+def topological_order(tasks):
+    '''
+    Returns the names of a graph of tasks (see run_task_graph) ordered so
+    that each task comes after the tasks it depends on. Dependencies which
+    aren't in the graph are ignored. Raises a ValueError if the graph has a
+    cycle.
+    
+    >>> topological_order({'a': (abs, (), ('b', 'x')), 'b': (abs, (), ()),
+    ...                    'c': (abs, (), ('a', 'b'))})
+    ['b', 'a', 'c']
+    '''
+    dependents = dict([(name, []) for name in tasks])
+    counts = {}
+    
+    for name, (function, arguments, dependencies) in tasks.iteritems():
+        dependencies = set(dependencies).intersection(tasks)
+        counts[name] = len(dependencies)
+        
+        for dependency in dependencies:
+            dependents[dependency].append(name)
+    
+    ready = sorted([name for name in tasks if counts[name] == 0])
+    order = []
+    
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        
+        for dependent in sorted(dependents[name]):
+            counts[dependent] -= 1
+            
+            if counts[dependent] == 0:
+                ready.append(dependent)
+    
+    if len(order) < len(tasks):
+        raise ValueError('the dependencies of %s have a cycle' % 
+                         ', '.join(sorted(set(tasks) - set(order))))
+    
+    return order
+
+def task_job(task):
+    '''
+    Calls the function of a (name, function, arguments) task, for use with
+    multiprocessing.Pool. Returns the name and None, or the name and the
+    error message if the function raised an exception, which is logged.
+    '''
+    name, function, arguments = task
+    
+    try:
+        function(*arguments)
+    except Exception, e:
+        log.error('%s failed: %s' % (name, e))
+        return name, str(e)
     
+    log.debug('finished %s' % name)
+    
+    return name, None
+
 def create_ngram_kernel(alphabet_size, order, fstlist):
     '''
     Creates an n-gram using klngram with specified alphabet size and order.
     '''
-    
-    kernel_path = os.path.join( os.path.dirname(fstlist), '%i-gram.kar' % order)
+    compile_kernel(run_klngram(alphabet_size, order, fstlist))
+
+def ngram_kernel_path(order, fstlist):
+    '''
+    Returns the path of the n-gram kernel of an fstlist made by klngram.
+    '''
+    return os.path.join( os.path.dirname(fstlist), '%i-gram.kar' % order)
+
+def run_klngram(alphabet_size, order, fstlist):
+    '''
+    Runs klngram to make the n-gram kernel of an fstlist. Returns the path of
+    the kernel, or raises an OSError if klngram fails.
+    '''
+    kernel_path = ngram_kernel_path(order, fstlist)
     kernel_file = open(kernel_path, 'wb')
     
     
@@ -78,15 +559,19 @@ def create_ngram_kernel(alphabet_size, order, fstlist):
                  fstlist]
     
     log.info(' '.join(arguments))
-    subprocess.call(arguments, stdout=kernel_file) #stderr=open('/dev/null', 'w'))
+    status = subprocess.call(arguments, stdout=kernel_file) #stderr=open('/dev/null', 'w'))
     
     kernel_file.close()
     
-    compile_kernel(kernel_path)
+    if status != 0:
+        raise OSError('klngram exited with status %i' % status)
+    
+    return kernel_path
 
 def compile_kernel(kernel_filename):
     '''
     Compiles a kernel into a libsvm compatible matrix .kar file using kleval.
+    Raises an OSError if kleval fails.
     '''
     matrix_filename = os.path.splitext(kernel_filename)[0] + '.matrix.kar'
     matrix_file = open(matrix_filename, 'wb')
@@ -99,10 +584,13 @@ def compile_kernel(kernel_filename):
     
     log.info(' '.join(arguments))
     
-    subprocess.call(arguments, stdout=matrix_file, stderr=open('/dev/null', 'w'))
+    status = subprocess.call(arguments, stdout=matrix_file, stderr=open('/dev/null', 'w'))
     
     matrix_file.close()
     
+    if status != 0:
+        raise OSError('kleval exited with status %i' % status)
+    
     return matrix_filename
 
 def determine_alphabet_size(symbol_filename):
@@ -119,5 +607,238 @@ def determine_alphabet_size(symbol_filename):
     
     return sigma
 
+def native_ngram_kernel(order, fstlist):
+    '''
+    Makes the n-gram kernel of the given order without OpenKernel, for FSTs
+    that are single unweighted paths: K(x, y) is the number of pairs of
+    matching n-grams in x and y, the dot product of their n-gram count
+    vectors. The matrix is written in LIBSVM's precomputed kernel format
+    (see write_svm_kernel_files) next to the fstlist, as %i-gram.matrix for
+    all of the sentences and %i-gram.<split> for each sentences.<split>
+    file. Returns the kernel matrix, or None if it can't be made natively.
+    '''
+    directory = os.path.dirname(fstlist)
+    
+    try:
+        sequences = read_label_sequences(fstlist)
+    except ValueError, e:
+        log.error('%s: %s. Use the openkernel engine.' % (fstlist, e))
+        return None
+    
+    log.info('computing %i-gram kernel of %i sentences in %s' % 
+             (order, len(sequences), directory))
+    
+    matrix = ngram_kernel_matrix(sequences, order)
+    
+    write_svm_kernel_files(matrix, os.path.join(directory, 'fsts'), 
+                           os.path.join(directory, '%i-gram' % order))
+    
+    return matrix
+
+def native_ngram_kernel_task(order, fstlist):
+    '''
+    Calls native_ngram_kernel in a task of run_task_graph, raising a
+    ValueError if the kernel can't be made natively, and returning nothing so
+    that the matrix isn't sent back from the worker process.
+    '''
+    if native_ngram_kernel(order, fstlist) is None:
+        raise ValueError('%s is not made of unweighted paths' % fstlist)
+
+def read_label_sequences(fstlist):
+    '''
+    Returns the label sequence of each FST in an fstlist, read from the text
+    file (N.txt) next to each N.fst. If those were not kept, as in batch
+    mode, the symbols of each sentence are read from sentences.strings
+    instead. Raises a ValueError if an FST is weighted or not a single path.
+    '''
+    fst_paths = [line.strip() for line in open(fstlist) if line.strip() != '']
+    text_paths = [os.path.splitext(path)[0] + '.txt' for path in fst_paths]
+    
+    if fst_paths and not os.path.exists(text_paths[0]):
+        strings_path = os.path.join(os.path.dirname(fst_paths[0]), 
+                                    'sentences.strings')
+        
+        if os.path.exists(strings_path):
+            return [line.split() for line in open(strings_path)]
+    
+    return [read_fst_labels(text_path) for text_path in text_paths]
+
+def read_fst_labels(text_path):
+    '''
+    Returns the labels along the single unweighted path of an FST in text
+    form, as written by write_simple_fst_text.
+    '''
+    labels = []
+    state = 1
+    
+    for line in open(text_path):
+        fields = line.split()
+        
+        if len(fields) == 4:
+            if fields[0] != str(state) or fields[2] != fields[3]:
+                raise ValueError('%s is not a single path' % text_path)
+            
+            labels.append(fields[2])
+            state += 1
+        elif len(fields) > 4:
+            raise ValueError('%s is weighted' % text_path)
+    
+    return labels
+
+def ngram_kernel_matrix(sequences, order):
+    '''
+    Returns the n-gram count kernel of a list of symbol sequences as a dense
+    matrix: the product of the sparse matrix of n-gram counts, one row per
+    sequence, with its transpose.
+    
+    >>> ngram_kernel_matrix([['a', 'b', 'a'], ['a', 'b'], []], 1)
+    array([[5, 3, 0],
+           [3, 2, 0],
+           [0, 0, 0]])
+    >>> ngram_kernel_matrix([['a', 'b', 'a'], ['a', 'b'], []], 2)
+    array([[2, 1, 0],
+           [1, 1, 0],
+           [0, 0, 0]])
+    '''
+    counts = ngram_count_matrix(sequences, order)
+    
+    return (counts * counts.T).toarray()
+
+def ngram_count_matrix(sequences, order):
+    '''
+    Returns a SciPy CSR matrix with the count of each n-gram (column) in each
+    sequence (row).
+    '''
+    from scipy import sparse
+    
+    ngram_ids = {}
+    columns = []
+    row_starts = [0]
+    
+    for sequence in sequences:
+        for start in xrange(len(sequence) - order + 1):
+            ngram = tuple(sequence[start:start+order])
+            columns.append(ngram_ids.setdefault(ngram, len(ngram_ids)))
+        
+        row_starts.append(len(columns))
+    
+    # repeated n-grams in a row are summed into counts by the conversion
+    counts = sparse.csr_matrix((np.ones(len(columns), dtype=np.int64), 
+                                np.array(columns, dtype=np.int64), 
+                                np.array(row_starts, dtype=np.int64)),
+                               shape=(len(sequences), max(len(ngram_ids), 1)))
+    counts.sum_duplicates()
+    
+    return counts
+
+def write_svm_kernel_files(matrix, fst_directory, kernel_basepath):
+    '''
+    Writes the kernel rows of the sentences in each LIBSVM input file in
+    fst_directory (sentences.all, sentences.train, sentences.fold0.test...)
+    to kernel_basepath + the file's extension (see svm_input_files).
+    '''
+    for filename, extension in svm_input_files(fst_directory):
+        labels, serials = read_svm_input(os.path.join(fst_directory, filename))
+        write_precomputed_kernel(matrix, labels, serials, 
+                                 '%s.%s' % (kernel_basepath, extension))
+
+def svm_input_files(fst_directory):
+    '''
+    Returns the (filename, kernel extension) of each LIBSVM input file in
+    fst_directory: the extension of sentences.train is train, that of
+    sentences.fold0.test is fold0.test, and that of sentences.all is matrix.
+    
+    >>> import tempfile
+    >>> fst_directory = tempfile.mkdtemp()
+    >>> for filename in ['sentences.all', 'sentences.fold0.test', 'sentences.seed', '1.fst']:
+    ...     open(os.path.join(fst_directory, filename), 'w').close()
+    >>> svm_input_files(fst_directory)
+    [('sentences.all', 'matrix'), ('sentences.fold0.test', 'fold0.test')]
+    '''
+    files = []
+    
+    for filename in sorted(os.listdir(fst_directory)):
+        if filename.startswith('sentences.') and \
+                filename.endswith(('.all', '.train', '.test')):
+            extension = filename[len('sentences.'):]
+            
+            if extension == 'all':
+                extension = 'matrix'
+            
+            files.append((filename, extension))
+    
+    return files
+
+def read_svm_input(svm_filename):
+    '''
+    Reads the labels and 1-based sentence numbers from a LIBSVM input file
+    written by sentences2fst.write_svm_input, whose lines are "emotion N:1.0".
+    '''
+    labels = []
+    serials = []
+    
+    for line in open(svm_filename):
+        fields = line.split()
+        
+        if fields:
+            labels.append(fields[0])
+            serials.append(int(fields[1].split(':')[0]))
+    
+    return labels, serials
+
+def write_precomputed_kernel(matrix, labels, serials, kernel_filename, rows=None):
+    '''
+    Writes the rows of a kernel matrix for the given 1-based sentence numbers
+    in LIBSVM's precomputed kernel format (svm-train -t 4):
+    
+    label 0:serial 1:K(serial, 1) 2:K(serial, 2) ... n:K(serial, n)
+    
+    Every row has a column for every sentence, so that the serial numbers of
+    the training sentences can index them, for training and test files alike.
+    The row of each sentence is serial - 1, unless the matrix only has the
+    rows of some sentences, such as one read by read_precomputed_kernel, in
+    which case rows gives the index of each sentence's row.
+    '''
+    if rows is None:
+        rows = [serial - 1 for serial in serials]
+    
+    if matrix.dtype.kind in 'iu':
+        format_value = str
+    else:
+        format_value = lambda value: '%.10g' % value
+    
+    prefixes = ['%i:' % column for column in range(1, matrix.shape[1] + 1)]
+    kernel_file = open(kernel_filename, 'w')
+    
+    for label, serial, row in zip(labels, serials, rows):
+        values = ' '.join([prefix + value for prefix, value in 
+                           zip(prefixes, map(format_value, matrix[row].tolist()))])
+        kernel_file.write('%s 0:%i %s\n' % (label, serial, values))
+    
+    kernel_file.close()
+
+def read_precomputed_kernel(kernel_filename):
+    '''
+    Reads a file written by write_precomputed_kernel. Returns the labels,
+    the serial numbers and the kernel rows as a matrix.
+    '''
+    labels = []
+    serials = []
+    rows = []
+    
+    for line in open(kernel_filename):
+        fields = line.split()
+        
+        if fields:
+            labels.append(fields[0])
+            serials.append(int(fields[1].split(':')[1]))
+            rows.append([float(field.split(':')[1]) for field in fields[2:]])
+    
+    return labels, serials, np.array(rows)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        import doctest
+        doctest.testmod(verbose=False)
+    else:
+        main()
@@ -30,6 +30,9 @@ release 2: July 2008
 """
 
 import sys
+import re
+import time
+import utils
 
 class PorterStemmer:
 
@@ -51,9 +54,10 @@ class PorterStemmer:
 
     def cons(self, i):
         """cons(i) is TRUE <=> b[i] is a consonant."""
-        if self.b[i] == 'a' or self.b[i] == 'e' or self.b[i] == 'i' or self.b[i] == 'o' or self.b[i] == 'u':
+        c = self.b[i]
+        if c in 'aeiou':
             return 0
-        if self.b[i] == 'y':
+        if c == 'y':
             if i == self.k0:
                 return 1
             else:
@@ -344,24 +348,98 @@ class PorterStemmer:
         return self.b[self.k0:self.k+1]
 
 
+# memo of stem_word, shared by every caller. Only stems are kept in it, so
+# unlike a PorterStemmer instance it can be used by several callers at once.
+stem_cache = utils.LRUCache(100000)
+
+WORD_PATTERN = re.compile('[A-Za-z]+')
+
+def stem_uncached(word):
+    """Stems a lower case word with a PorterStemmer of its own."""
+    return PorterStemmer().stem(word, 0, len(word) - 1)
+
+def stem_word(word):
+    """Returns the stem of a lower case word, using the memo table.
+
+    >>> stem_word('caresses'), stem_word('ponies'), stem_word('generalizations')
+    ('caress', 'poni', 'gener')
+    """
+    return stem_cache.get(word, stem_uncached, word)
+
+def stem_many(words):
+    """Returns the stems of a sequence of lower case words, stemming each
+    distinct word once.
+
+    >>> stem_many(['running', 'runs', 'running'])
+    ['run', 'run', 'run']
+    """
+    stems = {}
+    for word in words:
+        if word not in stems:
+            stems[word] = stem_word(word)
+    return [stems[word] for word in words]
+
+def stem_line(line):
+    """Lower cases a line of text and replaces each run of letters with its
+    stem, leaving everything else as it is.
+
+    >>> stem_line('Happily, the Ponies ran.\\n')
+    'happili, the poni ran.\\n'
+    """
+    line = line.lower()
+    words = WORD_PATTERN.findall(line)
+    stems = dict(zip(words, stem_many(words)))
+    return WORD_PATTERN.sub(lambda match: stems[match.group()], line)
+
+def stem_file(infile, outfile):
+    """Writes each line of infile to outfile, stemmed by stem_line."""
+    for line in infile:
+        outfile.write(stem_line(line))
+
+def benchmark(words, repeat=3):
+    """Times stemming words with a single PorterStemmer, as the file mode
+    used to, against stem_many with an empty memo table and a full one.
+    Returns a list of (name, seconds) pairs, the best of repeat runs each.
+    """
+    def per_word():
+        p = PorterStemmer()
+        return [p.stem(word, 0, len(word) - 1) for word in words]
+
+    def cold():
+        stem_cache.entries.clear()
+        return stem_many(words)
+
+    def warm():
+        return stem_many(words)
+
+    if per_word() != cold():
+        raise ValueError('stem_many disagrees with PorterStemmer')
+
+    timings = []
+    for name, function in (('PorterStemmer.stem', per_word), 
+                           ('stem_many (cold)', cold), 
+                           ('stem_many (warm)', warm)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append((name, best))
+    return timings
+
+
 if __name__ == '__main__':
-    p = PorterStemmer()
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == '--benchmark':
+        words = []
+        for f in sys.argv[2:]:
+            words.extend(WORD_PATTERN.findall(open(f, 'r').read().lower()))
+        print '%i words, %i distinct' % (len(words), len(set(words)))
+        for name, seconds in benchmark(words):
+            print '%-20s %.3fs' % (name, seconds)
+    elif len(sys.argv) > 1:
         for f in sys.argv[1:]:
             infile = open(f, 'r')
-            while 1:
-                output = ''
-                word = ''
-                line = infile.readline()
-                if line == '':
-                    break
-                for c in line:
-                    if c.isalpha():
-                        word += c.lower()
-                    else:
-                        if word:
-                            output += p.stem(word, 0,len(word)-1)
-                            word = ''
-                        output += c.lower()
-                print output,
+            stem_file(infile, sys.stdout)
             infile.close()
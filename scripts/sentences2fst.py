@@ -19,6 +19,13 @@ from nltk.corpus import wordnet
 import linecache
 from decimal import Decimal
 import shutil
+import itertools
+import multiprocessing
+import hashlib
+import cPickle
+import zlib
+import numpy as np
+import utils
 
 import pdb
 
@@ -31,7 +38,29 @@ LOG_LEVELS = {'debug': logging.DEBUG,
 
 ANEW_DB = os.path.expanduser('~/affect/word_data/anew_all.txt')
 SENTI_DB = os.path.expanduser('~/affect/word_data/SentiWordNet_1.0.1.txt')
+SENTI_INDEX = os.path.expanduser('~/affect/word_data/SentiWordNet_1.0.1.index')
 WORD_LIST_DIR = os.path.expanduser('~/affect/word_data/lists')
+FST_CACHE_DIR = os.path.expanduser('~/affect/fst_cache')
+ANNOTATION_DIR = os.path.expanduser('~/affect/annotations')
+TOKEN_CACHE = os.path.expanduser('~/affect/token_cache')
+WORD_LIST_CACHE = os.path.expanduser('~/affect/word_list_cache')
+
+# increment whenever tokenization or tagging changes, so that previously
+# stored annotations are ignored.
+ANNOTATION_VERSION = 4
+
+# 'decimal' reproduces the exact Decimal arithmetic of tag_anew_sentence,
+# 'float' scores ANEW words with float32 arrays, which is faster but rounds
+# the weights of the FSTs.
+ANEW_PRECISION = 'decimal'
+ANEW_PRECISIONS = ('decimal', 'float')
+
+# 'nltk' tokenizes with nltk.word_tokenize, 'fast' with fast_word_tokenize
+TOKENIZER = 'nltk'
+TOKENIZERS = ('nltk', 'fast')
+
+# arc type passed to fstcompile. it is also part of each FST cache key.
+FST_ARC_TYPE = 'log'
 
 # all the possible FST options. Simple options are those that output a single
 # unweighted output path.
@@ -45,9 +74,58 @@ SIMPLE_FST_TYPES = ('words', 'lemmas', 'pos', 'lemmastems', 'lists')
 
 SPECIAL_PUNCTUATION = ['?', '!', '&']
 
+# number of sentences per process when POS tagging in parallel
+POS_CHUNK_SIZE = 500
+
+# minimum number of sentences read, tagged and written at a time
+SENTENCE_CHUNK_SIZE = 1000
+
 # symbols to ignore from the input sentences
 SYMBOLS_TO_IGNORE = ('"')
 
+# the quote tokens of newer NLTK tokenizers, which are read as '"'
+NLTK_QUOTES = ('``', "''")
+
+# the rules of NLTK's Treebank word tokenizer, as used by nltk.word_tokenize,
+# for fast_word_tokenize. Double quotes are kept as '"' rather than converted
+# to `` and ''. Each rule is only applied to text containing its trigger, if
+# it has one.
+TREEBANK_RULES = [(trigger, re.compile(pattern), replacement) 
+                    for trigger, pattern, replacement in [
+    ("'", r"(?i)(\')(?!re|ve|ll|m|t|s|d)(\w)\b", r'\1 \2'),
+    # punctuation, starting with the final period, which may be followed by
+    # a quote
+    ('.', r'([^\.])(\.)([\]\)}>"\']*)\s*$', r'\1 \2 \3 '),
+    ('"', r'"', r' " '),
+    (None, r'([:,])([^\d])', r' \1 \2'),
+    (None, r'([:,])$', r' \1 '),
+    ('...', r'\.\.\.', r' ... '),
+    (None, r'[;@#$%&]', r' \g<0> '),
+    (None, r'[?!]', r' \g<0> '),
+    ("'", r"([^'])' ", r"\1 ' "),
+    (None, r'[\]\[\(\)\{\}\<\>]', r' \g<0> '),
+    ('--', r'--', r' -- '),
+]]
+
+# the contraction rules, which apply to the text padded with spaces. NLTK
+# applies them one at a time; here they are one regular expression.
+TREEBANK_CONTRACTIONS = [(trigger, re.compile(pattern), replacement)
+                            for trigger, pattern, replacement in [
+    ("'", r"([^' ])('[sS]|'[mM]|'[dD]|') ", r"\1 \2 "),
+    ("'", r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ", r"\1 \2 "),
+    (None, r"(?i)\b(can)(not)\b|\b(d)('ye)\b|\b(gim)(me)\b|\b(gon)(na)\b|"
+           r"\b(got)(ta)\b|\b(lem)(me)\b|\b(mor)('n)\b|\b(wan)(na)\s|"
+           r" ('t)(is)\b| ('t)(was)\b", 
+     lambda match: ' %s %s ' % tuple([group for group in match.groups() 
+                                      if group is not None])),
+]]
+
+# where fast_word_tokenize splits text into sentences: after a ., ? or !
+# and any closing quotes or brackets, when followed by white space. Periods
+# after abbreviations and initials are skipped.
+SENTENCE_END = re.compile(r'''(?<![A-Z])(?<!\bMr)(?<!\bMrs)(?<!\bDr)(?<!\bSt)'''
+                          r'''([.?!]+["')\]]*)\s+''')
+
 WORDNET_POS = { 'a' : ['JJ', 'JJR', 'JJS'], #adjectives
                 'r' : ['RB', 'RBR', 'RBS'],
                 'n' : ['NN', 'NNS', 'NNP', 'NNPS'],
@@ -57,8 +135,25 @@ WORDNET_POS = { 'a' : ['JJ', 'JJR', 'JJS'], #adjectives
 logging.basicConfig()
 log = logging.getLogger("sentences2fst")
 
+# shared by every call to lemmatize_word and stem_word. the caches are keyed
+# by (word, WordNet POS) and word, respectively.
+LEMMATIZER = nltk.stem.WordNetLemmatizer()
+STEMMER = nltk.PorterStemmer()
+
+lemma_cache = utils.LRUCache(100000)
+stem_cache = utils.LRUCache(100000)
+
+# the TokenCache used by tokenize_sentence, if any
+token_cache = None
+
+# lexicons read by tag_sentences, keyed by (reader name, path), so each one
+# is read once per run rather than once per chunk of sentences
+lexicons = {}
+
 
 def main():
+    global ANEW_PRECISION, TOKENIZER, token_cache
+    
     usage = """%prog [options] SENTENCE_DIRECTORY 
             """
     
@@ -76,6 +171,83 @@ def main():
                         help="A directory of POS files to be read. Creates"
                         "a parallel path in the FST")
     
+    opt_parser.add_option("-j", "--jobs", action='store', type=int,
+                        default=multiprocessing.cpu_count(), dest='jobs',
+                        help="Number of FSTs to write and compile at once. "
+                        "Defaults to the number of CPUs.")
+    
+    opt_parser.add_option("-b", "--batch", action='store_true', 
+                        default=False, dest='batch',
+                        help="Compile all the FSTs of each type at once, "
+                        "in-process with pywrapfst if it is installed or as "
+                        "a single FST archive with farcompilestrings.")
+    
+    opt_parser.add_option("-c", "--cache_dir", action='store',
+                        default=FST_CACHE_DIR, dest='cache_dir',
+                        help="Directory of previously compiled FSTs, keyed by "
+                        "their contents. Defaults to %s" % FST_CACHE_DIR)
+    
+    opt_parser.add_option("--cache_size", action='store', type=int,
+                        default=1024, dest='cache_size',
+                        help="Maximum size of the FST cache in megabytes. The "
+                        "least recently used FSTs are removed beyond it.")
+    
+    opt_parser.add_option("--no_cache", action='store_false', 
+                        default=True, dest='use_cache',
+                        help="Compile every FST, ignoring the FST cache.")
+    
+    opt_parser.add_option("-a", "--annotation_dir", action='store',
+                        default=ANNOTATION_DIR, dest='annotation_dir',
+                        help="Directory of stored sentence annotations, one "
+                        "file per story. Defaults to %s" % ANNOTATION_DIR)
+    
+    opt_parser.add_option("--no_annotations", action='store_false',
+                        default=True, dest='use_annotations',
+                        help="Tokenize and tag every sentence, ignoring "
+                        "stored annotations.")
+    
+    opt_parser.add_option("--seed", action='store', type=int, dest='seed',
+                        help="Random seed for the train/test split. The same "
+                        "split is used for every FST type. Random by default.")
+    
+    opt_parser.add_option("--stratify", action='store_true', default=False,
+                        dest='stratify', help="Split each emotion into train "
+                        "and test sets separately.")
+    
+    opt_parser.add_option("-k", "--folds", action='store', type=int, 
+                        dest='folds', help="Also write train and test sets "
+                        "for k-fold cross validation.")
+    
+    opt_parser.add_option("--chunk_size", action='store', type=int,
+                        default=SENTENCE_CHUNK_SIZE, dest='chunk_size',
+                        help="Number of sentences to read, tag and write at "
+                        "a time. Whole stories are always kept together.")
+    
+    opt_parser.add_option("--anew_precision", action='store', type='choice',
+                        choices=ANEW_PRECISIONS, default=ANEW_PRECISION,
+                        dest='anew_precision', help="Score ANEW words "
+                        "exactly as Decimal ('decimal') or, faster but "
+                        "rounded, as float32 ('float'). Default: %default")
+    
+    opt_parser.add_option("--tokenizer", action='store', type='choice',
+                        choices=TOKENIZERS, default=TOKENIZER,
+                        dest='tokenizer', help="Tokenize with NLTK ('nltk') "
+                        "or with its Treebank rules as compiled regular "
+                        "expressions ('fast'). Default: %default")
+    
+    opt_parser.add_option("--token_cache", action='store', default=TOKEN_CACHE,
+                        dest='token_cache', help="File of cached sentence "
+                        "tokenizations. Defaults to %s" % TOKEN_CACHE)
+    
+    opt_parser.add_option("--no_token_cache", action='store_false',
+                        default=True, dest='use_token_cache',
+                        help="Tokenize every sentence, ignoring the token cache.")
+    
+    opt_parser.add_option("--check_tokenizer", action='store_true',
+                        default=False, dest='check_tokenizer',
+                        help="Report the sentences which the fast tokenizer "
+                        "splits differently from NLTK, and exit.")
+    
     options, arguments = opt_parser.parse_args()
     
     log.setLevel(LOG_LEVELS[options.log_level])
@@ -85,18 +257,85 @@ def main():
     sentence_directory = other_args[0]
     symbol_filename = options.symbol_table
     
-    sentence_dicts = read_agree_sentence_directory(sentence_directory)
+    if options.check_tokenizer:
+        report_tokenizer_divergences(sentence_directory)
+        return
     
-    for fst_type in fst_types:
-        if fst_type in SIMPLE_FST_TYPES:
-            tag_sentences(sentence_dicts, fst_type)
-            write_many_simple_fsts(sentence_dicts, fst_type)
-        else:
-            tag_sentences(sentence_dicts, fst_type)
-            if fst_type == 'senti':
-                write_many_multipath_fsts(sentence_dicts, fst_type)
-            else:
-                write_many_multipath_fsts(sentence_dicts, fst_type)
+    if options.use_cache:
+        cache = FSTCache(options.cache_dir, options.cache_size * 1024 * 1024)
+    else:
+        cache = None
+    
+    # the precision and tokenizer are part of the lexicon version of stored
+    # annotations
+    ANEW_PRECISION = options.anew_precision
+    TOKENIZER = options.tokenizer
+    
+    if options.use_token_cache:
+        token_cache = TokenCache(options.token_cache)
+    else:
+        token_cache = None
+    
+    if options.use_annotations:
+        store = AnnotationStore(options.annotation_dir)
+    else:
+        store = None
+    
+    if options.seed is None:
+        options.seed = random.randrange(2**31)
+    
+    log.info('splitting train and test sets with seed %i' % options.seed)
+    
+    split_options = {'seed' : options.seed,
+                     'stratify' : options.stratify,
+                     'folds' : options.folds}
+    
+    # one pool of processes tags every chunk, and is shared by all of the
+    # writers to compile FSTs
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+    else:
+        pool = None
+    
+    writers = [create_fst_writer(fst_type, jobs=options.jobs, batch=options.batch,
+                                 cache=cache, split_options=split_options, 
+                                 pool=pool) 
+                for fst_type in fst_types]
+    
+    sentences = iter_agree_sentence_directory(sentence_directory, store)
+    
+    for chunk in chunk_sentences(sentences, options.chunk_size):
+        for fst_type, writer in zip(fst_types, writers):
+            tag_sentences(chunk, fst_type, pool=pool, store=store)
+            writer.write(chunk)
+        
+        if store:
+            store.release(chunk)
+        
+        log.debug('wrote FSTs for %i sentences' % len(writers[0].emotions))
+    
+    for writer in writers:
+        writer.close()
+    
+    if pool:
+        pool.close()
+        pool.join()
+    
+    if cache:
+        cache.prune()
+    
+    # the index only grows as sentences are tagged, so save it once at the end
+    senti_index = lexicons.get((read_senti_index.__name__, SENTI_DB))
+    
+    if senti_index is not None:
+        senti_index.save()
+    
+    if token_cache is not None:
+        token_cache.save()
+        log.debug('token cache: %s' % token_cache)
+    
+    log.debug('lemma cache: %s' % lemma_cache)
+    log.debug('stem cache: %s' % stem_cache)
                 
 def parse_args(arguments):
     '''
@@ -116,17 +355,58 @@ def parse_args(arguments):
     
     return fst_types, other_args
 
-def read_agree_sentence_directory(sentence_directory):
+def read_agree_sentence_directory(sentence_directory, store=None):
+    '''
+    Reads a directory of high agree sentences into sentence dicts. If an
+    AnnotationStore is passed, stories that haven't changed since they were
+    stored are loaded from it, along with all of their tags.
+    '''
+    return list(iter_agree_sentence_directory(sentence_directory, store))
+
+def iter_agree_sentence_directory(sentence_directory, store=None):
     '''
-    Reads a directory of high agree sentences into sentence dicts.
+    Yields the sentence dicts of a directory of high agree sentences, one
+    story at a time. Each is given an 'index' key, its 0-based position in
+    the whole directory. If an AnnotationStore is passed, stories that
+    haven't changed since they were stored are loaded from it.
     '''
-    sentence_dicts = []
+    index = 0
     
     for sent_filename in os.listdir(sentence_directory):
         full_path = os.path.join(sentence_directory, sent_filename)
-        sentence_dicts.extend(read_agree_sents(full_path))
+        
+        if store:
+            story_dicts = store.load(full_path)
+        else:
+            story_dicts = read_agree_sents(full_path)
+        
+        for sent_dict in story_dicts:
+            sent_dict['index'] = index
+            index += 1
+            
+            yield sent_dict
+
+def chunk_sentences(sentence_dicts, chunk_size=SENTENCE_CHUNK_SIZE):
+    '''
+    Groups an iterable of sentence dicts into lists of at least chunk_size
+    sentences (apart from the last one). Lists are only split between
+    stories, so that each story is tagged and stored as a whole.
+    
+    >>> sents = [{'story' : story} for story in 'aaabbcd']
+    >>> [''.join([sent['story'] for sent in chunk]) for chunk in chunk_sentences(sents, 2)]
+    ['aaa', 'bb', 'cd']
+    '''
+    chunk = []
+    
+    for sent_dict in sentence_dicts:
+        if len(chunk) >= chunk_size and sent_dict.get('story') != chunk[-1].get('story'):
+            yield chunk
+            chunk = []
+        
+        chunk.append(sent_dict)
     
-    return sentence_dicts
+    if chunk:
+        yield chunk
 
 def read_agree_sents(filename):
     '''
@@ -135,6 +415,7 @@ def read_agree_sents(filename):
     1) 'id' : sentence id
     2) 'emotion' : emotion id (int)
     3) 'words' : the parsed words and interesting punctuation (list of strings)
+    4) 'story' : the story name, i.e. the filename without its extension
     '''
     
     result = []
@@ -152,7 +433,8 @@ def read_agree_sents(filename):
                 
                 sent_dict = {      'id' : sentence_id,
                               'emotion' : emotion,
-                                'words' : words
+                                'words' : words,
+                                'story' : story_name
                             }
                 
                 result.append(sent_dict)
@@ -163,58 +445,419 @@ def read_agree_sents(filename):
     return result
 
 
-def tokenize_sentence(sentence):
+def tokenize_sentence(sentence, tokenizer=None):
     '''
     Uses the default NLTK tokenizer, which as of July 2009 is the Penn
     TreeBank tokenizer which splits contractions. Also, strips off extra
-    periods that might show up mid-sentence.
+    periods that might show up mid-sentence. tokenizer is 'nltk' or 'fast'
+    (see fast_word_tokenize), by default TOKENIZER. If there is a token_cache,
+    sentences are only tokenized the first time they are seen.
     
     >>> tokenize_sentence("""One day, I went to the store where a man said "Don't buy the milk"!""")
     ['one', 'day', ',', 'i', 'went', 'to', 'the', 'store', 'where', 'a', 'man', 'said', '"', 'do', "n't", 'buy', 'the', 'milk', '"', '!']
     >>> tokenize_sentence("""He said, "I am hungry." And then he went home.""")
     ['he', 'said', ',', '"', 'i', 'am', 'hungry', '.', '"', 'and', 'then', 'he', 'went', 'home', '.']
+    >>> tokenize_sentence("""He said, "I am hungry." And then he went home.""", 'fast')
+    ['he', 'said', ',', '"', 'i', 'am', 'hungry', '.', '"', 'and', 'then', 'he', 'went', 'home', '.']
+    
+    '''
+    if tokenizer is None:
+        tokenizer = TOKENIZER
     
+    if token_cache is not None:
+        return list(token_cache.get(sentence, tokenizer))
+    else:
+        return tokenize_uncached(sentence, tokenizer)
+
+def tokenize_uncached(sentence, tokenizer):
+    '''
+    Does the tokenizing for tokenize_sentence, which may cache the results.
     '''
+    if tokenizer == 'fast':
+        words = fast_word_tokenize(sentence)
+    else:
+        words = nltk_word_tokenize(sentence)
     
-    words = [word.lower() for word in nltk.word_tokenize(sentence)]
+    words = [word.lower() for word in words]
     stripped_words = []
     
-    # strip periods that the tokenizer left on
+    # strip the symbols to ignore from words, keeping symbols themselves as
+    # tokens for read_agree_sents to filter out
     for word in words:
-        if word not in SYMBOLS_TO_IGNORE:
+        if word in SYMBOLS_TO_IGNORE:
+            stripped_words.append(word)
+        else:
             for symbol in SYMBOLS_TO_IGNORE:
-                stripped_words.append(word.replace(symbol, ''))
+                word = word.replace(symbol, '')
+            
+            if word:
+                stripped_words.append(word)
     
     return stripped_words
 
-def tag_sentences(sentence_dicts, tag_type):
-    # check if it's already been tagged
-    if tag_type in sentence_dicts[0]:
+def nltk_word_tokenize(sentence):
+    '''
+    Tokenizes with nltk.word_tokenize, reading the `` and '' quote tokens of
+    newer versions of NLTK as '"'.
+    '''
+    return [word in NLTK_QUOTES and '"' or word 
+            for word in nltk.word_tokenize(sentence)]
+
+def fast_word_tokenize(sentence):
+    '''
+    Tokenizes like nltk_word_tokenize, but without NLTK's Punkt sentence
+    splitter: the text is split into sentences after ., ? and ! by
+    SENTENCE_END and then each is tokenized by the Treebank rules in
+    TREEBANK_RULES and TREEBANK_CONTRACTIONS. Abbreviations that Punkt knows
+    about may be split differently; see report_tokenizer_divergences.
+    
+    >>> fast_word_tokenize("They'll save and invest more, can't they?")
+    ['They', "'ll", 'save', 'and', 'invest', 'more', ',', 'ca', "n't", 'they', '?']
+    >>> fast_word_tokenize('Mr. Smith said "Stop." Then he left.')
+    ['Mr.', 'Smith', 'said', '"', 'Stop', '.', '"', 'Then', 'he', 'left', '.']
+    '''
+    words = []
+    
+    for text in SENTENCE_END.sub(r'\1\n', sentence).split('\n'):
+        for trigger, regexp, substitution in TREEBANK_RULES:
+            if trigger is None or trigger in text:
+                text = regexp.sub(substitution, text)
+        
+        text = ' %s ' % text
+        
+        for trigger, regexp, substitution in TREEBANK_CONTRACTIONS:
+            if trigger is None or trigger in text:
+                text = regexp.sub(substitution, text)
+        
+        words.extend(text.split())
+    
+    return words
+
+def tokenizer_divergences(sentences):
+    '''
+    Returns a (sentence, NLTK tokens, fast tokens) triple for each sentence
+    that fast_word_tokenize splits differently from nltk_word_tokenize.
+    '''
+    divergences = []
+    
+    for sentence in sentences:
+        nltk_words = nltk_word_tokenize(sentence)
+        fast_words = fast_word_tokenize(sentence)
+        
+        if nltk_words != fast_words:
+            divergences.append((sentence, nltk_words, fast_words))
+    
+    return divergences
+
+def report_tokenizer_divergences(sentence_directory):
+    '''
+    Logs every sentence in a directory of high agree sentences which the
+    fast tokenizer splits differently from NLTK, with the tokens that differ,
+    and returns the number of them.
+    '''
+    sentences = []
+    
+    for sent_filename in sorted(os.listdir(sentence_directory)):
+        for line in open(os.path.join(sentence_directory, sent_filename)):
+            fields = line.split('@')
+            
+            if len(fields) == 3:
+                sentences.append(fields[2])
+    
+    divergences = tokenizer_divergences(sentences)
+    
+    for sentence, nltk_words, fast_words in divergences:
+        log.warning('tokenizers differ on: %s' % sentence.strip())
+        log.warning('  nltk only: %s' % ' '.join([word for word in nltk_words 
+                                                    if word not in fast_words]))
+        log.warning('  fast only: %s' % ' '.join([word for word in fast_words
+                                                    if word not in nltk_words]))
+    
+    log.warning('%i of %i sentences are tokenized differently' % 
+                (len(divergences), len(sentences)))
+    
+    return len(divergences)
+
+class TokenCache:
+    '''
+    A persistent cache of sentence tokenizations, keyed by a hash of the
+    tokenizer and the sentence text, and saved as a compressed pickle. It is
+    discarded when ANNOTATION_VERSION or the version of NLTK changes.
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self.version = (ANNOTATION_VERSION, getattr(nltk, '__version__', ''))
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        
+        self.tokens = self.read()
+        
+        if self.tokens is None:
+            self.tokens = {}
+    
+    def __len__(self):
+        return len(self.tokens)
+    
+    def __str__(self):
+        return '%i hits, %i misses, %i entries' % (self.hits, self.misses, len(self))
+    
+    def get(self, sentence, tokenizer):
+        '''
+        Returns the tokens of a sentence, tokenizing it if it isn't cached.
+        '''
+        key = hashlib.sha1('%s\n%s' % (tokenizer, sentence)).digest()
+        
+        try:
+            words = self.tokens[key]
+            self.hits += 1
+        except KeyError:
+            words = tuple(tokenize_uncached(sentence, tokenizer))
+            self.tokens[key] = words
+            self.misses += 1
+            self.changed = True
+        
+        return words
+    
+    def read(self):
+        '''
+        Returns the saved tokens, or None if there are none or they are from
+        another version.
+        '''
+        try:
+            data = open(self.path, 'rb').read()
+            version, tokens = cPickle.loads(zlib.decompress(data))
+        except (IOError, zlib.error, cPickle.UnpicklingError, EOFError, ValueError), e:
+            return None
+        
+        if version != self.version:
+            return None
+        
+        return tokens
+    
+    def save(self):
+        '''
+        Saves the cache, if any sentences were added to it.
+        '''
+        if not self.changed:
+            return
+        
+        data = zlib.compress(cPickle.dumps((self.version, self.tokens), 
+                                           cPickle.HIGHEST_PROTOCOL))
+        temp_path = '%s.%i.tmp' % (self.path, os.getpid())
+        
+        try:
+            directory = os.path.dirname(self.path)
+            
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            
+            open(temp_path, 'wb').write(data)
+            os.rename(temp_path, self.path)
+            self.changed = False
+        except (IOError, OSError), e:
+            log.warning('could not save token cache %s: %s' % (self.path, e))
+
+class AnnotationStore:
+    '''
+    Stores tokenized and tagged sentence dicts on disk, one compressed pickle
+    per story, so that tagging an unchanged corpus is only done once. A
+    stored story is used only if its source file is unchanged (same mtime
+    and size, or failing that, the same SHA-1) and it was tagged with the
+    same ANNOTATION_VERSION and lexicons.
+    '''
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.lexicon_version = lexicon_version()
+        
+        # story name -> (source fingerprint, sentence dicts) for every story
+        # loaded through the store
+        self.stories = {}
+        
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    
+    def store_path(self, source_path):
+        '''
+        Returns the annotation filename for a story. Includes a hash of the
+        full source path, since stories of the same name are found in
+        several sentence directories.
+        '''
+        source_path = os.path.realpath(source_path)
+        story = os.path.splitext(os.path.basename(source_path))[0]
+        
+        return os.path.join(self.directory, '%s.%s.annotations' % 
+                            (story, hashlib.sha1(source_path).hexdigest()[:8]))
+    
+    def load(self, source_path):
+        '''
+        Returns the sentence dicts for a story, from the store if they are
+        still valid or by reading source_path otherwise.
+        '''
+        stat = os.stat(source_path)
+        fingerprint = {'version' : ANNOTATION_VERSION,
+                       'lexicons' : self.lexicon_version,
+                       'mtime' : stat.st_mtime,
+                       'size' : stat.st_size,
+                       'sha1' : None}
+        
+        stored = self.read(source_path)
+        sentence_dicts = None
+        
+        if stored:
+            stored_fingerprint, stored_dicts = stored
+            
+            if stored_fingerprint['version'] == ANNOTATION_VERSION and \
+                    stored_fingerprint['lexicons'] == self.lexicon_version:
+                if (stored_fingerprint['mtime'], stored_fingerprint['size']) == \
+                        (stat.st_mtime, stat.st_size):
+                    sentence_dicts = stored_dicts
+                    fingerprint['sha1'] = stored_fingerprint['sha1']
+                else:
+                    fingerprint['sha1'] = file_sha1(source_path)
+                    
+                    if fingerprint['sha1'] == stored_fingerprint['sha1']:
+                        sentence_dicts = stored_dicts
+        
+        if sentence_dicts is None:
+            log.debug('reading %s' % source_path)
+            sentence_dicts = read_agree_sents(source_path)
+            
+            if fingerprint['sha1'] is None:
+                fingerprint['sha1'] = file_sha1(source_path)
+        
+        self.stories[source_path] = (fingerprint, sentence_dicts)
+        
+        return sentence_dicts
+    
+    def read(self, source_path):
+        '''
+        Returns the stored (fingerprint, sentence dicts) pair for a story, or
+        None if there isn't one.
+        '''
+        try:
+            data = open(self.store_path(source_path), 'rb').read()
+            return cPickle.loads(zlib.decompress(data))
+        except (IOError, zlib.error, cPickle.UnpicklingError, EOFError), e:
+            return None
+    
+    def save(self, sentence_dicts):
+        '''
+        Writes every story with a sentence in sentence_dicts back to the store.
+        '''
+        stories = set([sent_dict.get('story') for sent_dict in sentence_dicts])
+        
+        for source_path, (fingerprint, story_dicts) in self.stories.iteritems():
+            if story_dicts and story_dicts[0]['story'] in stories:
+                store_path = self.store_path(source_path)
+                temp_path = '%s.%i.tmp' % (store_path, os.getpid())
+                
+                data = cPickle.dumps((fingerprint, story_dicts), cPickle.HIGHEST_PROTOCOL)
+                
+                f = open(temp_path, 'wb')
+                f.write(zlib.compress(data))
+                f.close()
+                
+                os.rename(temp_path, store_path)
+    
+    def release(self, sentence_dicts):
+        '''
+        Forgets the stories of sentence_dicts, which can then no longer be
+        saved, so that their memory can be reclaimed.
+        '''
+        stories = set([sent_dict.get('story') for sent_dict in sentence_dicts])
+        
+        for source_path, (fingerprint, story_dicts) in self.stories.items():
+            if not story_dicts or story_dicts[0]['story'] in stories:
+                del self.stories[source_path]
+
+def lexicon_version():
+    '''
+    Returns a string which changes whenever one of the lexicons used for
+    tagging (ANEW, SentiWordNet, the word lists) or NLTK changes.
+    '''
+    paths = [ANEW_DB, SENTI_DB]
+    
+    if os.path.isdir(WORD_LIST_DIR):
+        paths.extend([os.path.join(WORD_LIST_DIR, filename) 
+                        for filename in sorted(os.listdir(WORD_LIST_DIR))
+                        if filename.endswith('.list')])
+    
+    digest = hashlib.sha1(getattr(nltk, '__version__', ''))
+    digest.update('anew precision %s\n' % ANEW_PRECISION)
+    digest.update('tokenizer %s\n' % TOKENIZER)
+    
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update('%s\t%s\t%s\n' % (path, stat.st_mtime, stat.st_size))
+        else:
+            digest.update('%s\tmissing\n' % path)
+    
+    return digest.hexdigest()
+
+def file_sha1(path):
+    '''
+    Returns the hex SHA-1 of a file's contents.
+    '''
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+
+def tag_sentences(sentence_dicts, tag_type, pool=None, store=None):
+    '''
+    Adds tag_type tags to every sentence that doesn't have them yet, along
+    with any tags they depend on. POS tags are made in the pool of processes
+    if one is passed. If an AnnotationStore is passed, the stories of any
+    newly tagged sentences are saved to it.
+    '''
+    # only tag sentences that haven't been tagged, e.g. by a stored story
+    sentence_dicts = [sent for sent in sentence_dicts if tag_type not in sent]
+    
+    if not sentence_dicts:
         return
     
     if tag_type == 'pos':
-        [pos_tag_sentence(sent) for sent in sentence_dicts]
+        pos_tag_sentences(sentence_dicts, pool)
     elif tag_type == 'lemmas':
         log.debug('lemmatizing words')
-        tag_sentences(sentence_dicts, 'pos')
+        tag_sentences(sentence_dicts, 'pos', pool)
         [lemmatize_sentence(sent) for sent in sentence_dicts]
     elif tag_type == 'lemmastems':
-        tag_sentences(sentence_dicts, 'lemmas')
+        tag_sentences(sentence_dicts, 'lemmas', pool)
         [lemmastem_sentence(sent) for sent in sentence_dicts]
     elif tag_type == 'anew':
-        anew = read_anew_db(ANEW_DB)
-        [tag_anew_sentence(sent, anew) for sent in sentence_dicts]
+        anew_table = load_lexicon(read_anew_table, ANEW_DB)
+        # like tag_anew_sentence, lemmatize without POS tags if need be
+        [lemmatize_sentence(sent) for sent in sentence_dicts 
+            if 'lemmas' not in sent]
+        anew_table.tag_sentences(sentence_dicts, ANEW_PRECISION)
     elif tag_type == 'senti':
-        sentiwordnet = read_sentiwordnet(SENTI_DB)
-        [tag_swn_sentence(sent, sentiwordnet) for sent in sentence_dicts]
+        senti_index = load_lexicon(read_senti_index, SENTI_DB)
+        tag_sentences(sentence_dicts, 'lemmas', pool)
+        [senti_index.tag_sentence(sent) for sent in sentence_dicts]
     elif tag_type == 'lists':
-        word_lists = read_word_lists(WORD_LIST_DIR)
-        tag_sentences(sentence_dicts, 'lemmas')
-        [tag_sentence_for_lists(sent, word_lists) for sent in sentence_dicts]
+        matcher = load_lexicon(read_word_list_matcher, WORD_LIST_DIR)
+        tag_sentences(sentence_dicts, 'lemmas', pool)
+        [matcher.tag_sentence(sent) for sent in sentence_dicts]
     elif tag_type == 'words':
         # do nothing for words
         pass
+    
+    if store:
+        store.save(sentence_dicts)
 
+def load_lexicon(reader, path):
+    '''
+    Returns reader(path), only calling reader the first time.
+    '''
+    key = (reader.__name__, path)
+    
+    if key not in lexicons:
+        log.debug('reading %s' % path)
+        lexicons[key] = reader(path)
+    
+    return lexicons[key]
 
 def pos_tag_sentence(sent_dict):
     '''
@@ -231,6 +874,44 @@ def pos_tag_sentence(sent_dict):
     # unzip the pairs using zip(*)
     sent_dict['pos'] = zip(*word_tag_pairs)[1]
 
+def pos_tag_sentences(sentence_dicts, pool=None):
+    '''
+    Creates part of speech tags for every sentence in one pass, loading the
+    tagger once instead of once per sentence. If a pool of processes is
+    passed, the corpus is split into chunks of POS_CHUNK_SIZE sentences
+    which are tagged in it. The pool is left open, so that the caller can
+    tag every chunk of a corpus in the same processes. The tags are the same
+    as pos_tag_sentence's.
+    
+    >>> sents = [{'words' : ['So', 'the', 'father', 'gave', 'him', 'his', 'blessing', '.']}, {'words' : []}]
+    >>> pos_tag_sentences(sents)
+    >>> [sent['pos'] for sent in sents]
+    [('IN', 'DT', 'NN', 'VBD', 'PRP', 'PRP$', 'NN', '.'), ()]
+    '''
+    word_lists = [sent_dict['words'] for sent_dict in sentence_dicts]
+    
+    if pool and len(word_lists) > POS_CHUNK_SIZE:
+        chunks = [word_lists[start:start+POS_CHUNK_SIZE] 
+                    for start in range(0, len(word_lists), POS_CHUNK_SIZE)]
+        
+        tagged_lists = itertools.chain(*pool.map(pos_tag_word_lists, chunks))
+    else:
+        tagged_lists = pos_tag_word_lists(word_lists)
+    
+    for sent_dict, word_tag_pairs in itertools.izip(sentence_dicts, tagged_lists):
+        sent_dict['pos'] = tuple([tag for word, tag in word_tag_pairs])
+
+def pos_tag_word_lists(word_lists):
+    '''
+    Tags a list of word lists with a single tagger, using whichever batch
+    tagging function this version of NLTK provides. Returns a list of lists
+    of (word, tag) pairs.
+    '''
+    if hasattr(nltk, 'pos_tag_sents'):
+        return nltk.pos_tag_sents(word_lists)
+    else:
+        return nltk.batch_pos_tag(word_lists)
+
 def lemmatize_sentence(sent_dict):
     '''
     Adds lemmas to the sent_dict using the WordNet lemmatizer. It will be
@@ -279,9 +960,6 @@ def tag_swn_sentence(sent_dict, sentiwordnet):
     to look up each word in SentiWordnet, the words will be lemmatized and
     POS-tagged if they haven't been yet.
     '''
-    # weights for matching synsets
-    synset_weights = [1., 0.8, 0.6, 0.4, 0.2]
-    
     if 'pos' not in sent_dict:
         pos_tag_sentence(sent_dict)
     
@@ -292,26 +970,193 @@ def tag_swn_sentence(sent_dict, sentiwordnet):
     neg_swn = []
     
     for lemma, pos in zip(sent_dict['lemmas'], sent_dict['pos']):
-        synsets = wordnet.synsets(lemma, wordnet_pos(pos))
-        
-        pos_value = 0.0
-        neg_value = 0.0
-        
-        if synsets != []:
-            for synset, weight in zip(synsets, synset_weights):
-                synset_pair = (synset.pos, synset.offset)
-            
-                if synset_pair in sentiwordnet:
-                    swn_values = sentiwordnet[synset_pair]
-                    
-                    pos_value += weight * swn_values['pos']
-                    neg_value += weight * swn_values['neg']
+        pos_value, neg_value = swn_scores(lemma, wordnet_pos(pos), sentiwordnet)
         
         pos_swn.append(pos_value)
         neg_swn.append(neg_value)
     
     sent_dict['senti'] = {'pos' : pos_swn, 'neg' : neg_swn}
 
+def swn_scores(lemma, wn_pos, sentiwordnet):
+    '''
+    Returns the (pos, neg) SentiWordNet scores of a lemma: the scores of its
+    first five synsets, weighted by [1., 0.8, 0.6, 0.4, 0.2]. If the lemma
+    has no synsets in SentiWordNet, both scores are 0.
+    '''
+    # weights for matching synsets
+    synset_weights = [1., 0.8, 0.6, 0.4, 0.2]
+    
+    pos_value = 0.0
+    neg_value = 0.0
+    
+    for synset, weight in zip(wordnet.synsets(lemma, wn_pos), synset_weights):
+        synset_pair = synset_key(synset)
+        
+        if synset_pair in sentiwordnet:
+            swn_values = sentiwordnet[synset_pair]
+            
+            pos_value += weight * swn_values['pos']
+            neg_value += weight * swn_values['neg']
+    
+    return pos_value, neg_value
+
+def synset_key(synset):
+    '''
+    Returns the (POS, offset) pair of a WordNet synset, which are attributes
+    in older versions of NLTK and methods in NLTK 3.
+    
+    >>> class Synset: pos, offset = 'a', 1005286
+    >>> synset_key(Synset)
+    ('a', 1005286)
+    >>> class Synset3:
+    ...     def pos(self): return 'a'
+    ...     def offset(self): return 1005286
+    >>> synset_key(Synset3())
+    ('a', 1005286)
+    '''
+    pos, offset = synset.pos, synset.offset
+    
+    if callable(pos):
+        pos = pos()
+    
+    if callable(offset):
+        offset = offset()
+    
+    return (pos, offset)
+
+class SentiIndex:
+    '''
+    Maps (lemma, WordNet POS) pairs directly to their weighted (pos, neg)
+    SentiWordNet scores, as given by swn_scores, so that tagging a word is a
+    single dict lookup. The index is built once from SentiWordNet and every
+    WordNet lemma name, and saved as a compressed pickle at index_path.
+    
+    Pairs that aren't in the index, e.g. inflected forms which WordNet
+    resolves with morphy or words tagged without a WordNet POS, are scored on
+    first use and added to the index, which is saved again by save(), once
+    all of the sentences have been tagged.
+    '''
+    
+    def __init__(self, sentiwordnet_path, index_path):
+        self.sentiwordnet_path = sentiwordnet_path
+        self.index_path = index_path
+        self.version = senti_index_version(sentiwordnet_path)
+        self.changed = False
+        
+        self.scores = self.read()
+        
+        if self.scores is None:
+            self.scores = self.build()
+            self.save()
+    
+    def __len__(self):
+        return len(self.scores)
+    
+    def lookup(self, lemma, wn_pos):
+        '''
+        Returns the (pos, neg) scores for a lemma and WordNet POS.
+        '''
+        key = (lemma, wn_pos)
+        
+        try:
+            return self.scores[key]
+        except KeyError:
+            sentiwordnet = load_lexicon(read_sentiwordnet_table, 
+                                        self.sentiwordnet_path)
+            self.scores[key] = swn_scores(lemma, wn_pos, sentiwordnet)
+            self.changed = True
+            
+            return self.scores[key]
+    
+    def tag_sentence(self, sent_dict):
+        '''
+        Adds 'senti' tags to a lemmatized and POS-tagged sentence, like
+        tag_swn_sentence.
+        '''
+        scores = [self.lookup(lemma, wordnet_pos(pos)) for lemma, pos 
+                    in zip(sent_dict['lemmas'], sent_dict['pos'])]
+        
+        if scores:
+            pos_swn, neg_swn = [list(column) for column in zip(*scores)]
+        else:
+            pos_swn, neg_swn = [], []
+        
+        sent_dict['senti'] = {'pos' : pos_swn, 'neg' : neg_swn}
+    
+    def build(self):
+        '''
+        Scores every lemma name in WordNet for its own POS.
+        '''
+        log.info('building SentiWordNet index %s' % self.index_path)
+        sentiwordnet = load_lexicon(read_sentiwordnet_table, 
+                                    self.sentiwordnet_path)
+        scores = {}
+        
+        for wn_pos in (wordnet.NOUN, wordnet.VERB, wordnet.ADJ, wordnet.ADV):
+            for lemma in wordnet.all_lemma_names(wn_pos):
+                scores[(lemma, wn_pos)] = swn_scores(lemma, wn_pos, sentiwordnet)
+        
+        self.changed = True
+        
+        return scores
+    
+    def read(self):
+        '''
+        Returns the saved index, or None if there is none or it was built
+        from a different SentiWordNet or WordNet.
+        '''
+        try:
+            data = open(self.index_path, 'rb').read()
+            version, scores = cPickle.loads(zlib.decompress(data))
+        except (IOError, zlib.error, cPickle.UnpicklingError, EOFError, ValueError), e:
+            return None
+        
+        if version != self.version:
+            return None
+        
+        return scores
+    
+    def save(self):
+        '''
+        Saves the index, if it has changed since it was read.
+        '''
+        if not self.changed:
+            return
+        
+        data = zlib.compress(cPickle.dumps((self.version, self.scores), 
+                                           cPickle.HIGHEST_PROTOCOL))
+        
+        # write to a temporary file first, so the index is never left half
+        # written
+        temp_path = '%s.%i.tmp' % (self.index_path, os.getpid())
+        
+        try:
+            open(temp_path, 'wb').write(data)
+            os.rename(temp_path, self.index_path)
+            self.changed = False
+        except (IOError, OSError), e:
+            log.warning('could not save SentiWordNet index %s: %s' % 
+                        (self.index_path, e))
+
+def senti_index_version(sentiwordnet_path):
+    '''
+    Returns a string which changes whenever SentiWordNet, WordNet or NLTK
+    does.
+    '''
+    digest = hashlib.sha1(getattr(nltk, '__version__', ''))
+    digest.update('%s\n' % getattr(wordnet, 'get_version', lambda: '')())
+    
+    stat = os.stat(sentiwordnet_path)
+    digest.update('%s\t%s\t%s\n' % (sentiwordnet_path, stat.st_mtime, stat.st_size))
+    
+    return digest.hexdigest()
+
+def read_senti_index(path):
+    '''
+    Returns the SentiIndex for the SentiWordNet file at path.
+    '''
+    return SentiIndex(path, SENTI_INDEX)
+
 def tag_anew_sentence(sent_dict, anew):
     '''
     Attempts to tag the words in a sentence with their corresponding ANEW mean
@@ -340,10 +1185,8 @@ def tag_anew_sentence(sent_dict, anew):
             arousal = anew[lemma]['arousal']['mean']
             dominance = anew[lemma]['dominance']['mean']
         
-        valence = (valence - Decimal('5.')) / Decimal('4.')
-        arousal /= Decimal('8.')
-        dominance /= Decimal('8.')
-        valence_arousal = valence * arousal
+        valence, arousal, dominance, valence_arousal = \
+            anew_scores(valence, arousal, dominance)
         
         valence_list.append(valence)
         arousal_list.append(arousal)
@@ -355,6 +1198,126 @@ def tag_anew_sentence(sent_dict, anew):
                          'dominance' : dominance_list,
                          'valence*arousal' : valence_arousal_list}
 
+def anew_scores(valence, arousal, dominance):
+    '''
+    Scales ANEW means to the path weights: valence to [-1, 1] around the
+    middle value 5, arousal and dominance to [0, 1], and their product
+    valence*arousal. Works on Decimals, floats or NumPy arrays alike.
+    
+    >>> anew_scores(Decimal('7.21'), Decimal('5.53'), Decimal('4.00'))
+    (Decimal('0.5525'), Decimal('0.69125'), Decimal('0.50'), Decimal('0.381915625'))
+    '''
+    if isinstance(valence, Decimal):
+        valence = (valence - Decimal('5.')) / Decimal('4.')
+        arousal /= Decimal('8.')
+        dominance /= Decimal('8.')
+    else:
+        valence = (valence - 5) / 4
+        arousal = arousal / 8
+        dominance = dominance / 8
+    
+    return valence, arousal, dominance, valence * arousal
+
+class AnewTable:
+    '''
+    The ANEW lexicon as a float32 NumPy table, with a row per word and a
+    column for each of ANEW_COLUMNS. The last row holds the scores given to
+    words that aren't in ANEW: a valence of 5 and an arousal and dominance of
+    0, as in tag_anew_sentence.
+    
+    >>> anew = {'happy' : {'valence' : {'mean' : Decimal('8.21'), 'stdev' : Decimal('1.82')}, 'arousal' : {'mean' : Decimal('6.49'), 'stdev' : Decimal('2.77')}, 'dominance' : {'mean' : Decimal('6.63'), 'stdev' : Decimal('2.43')}}}
+    >>> table = AnewTable(anew)
+    >>> table.row_indices({'words' : ['Happy', 'happy'], 'lemmas' : ['happy', 'happy']})
+    [0, 0]
+    >>> sent = {'words' : ['so', 'happy'], 'lemmas' : ['so', 'happy']}
+    >>> table.tag_sentences([sent], 'decimal')
+    >>> sent['anew']['valence']
+    [Decimal('0'), Decimal('0.8025')]
+    >>> table.tag_sentences([sent], 'float')
+    >>> [str(value) for value in sent['anew']['valence']]
+    ['0.0', '0.8025']
+    '''
+    ANEW_COLUMNS = (('valence', 'mean'), ('valence', 'stdev'),
+                    ('arousal', 'mean'), ('arousal', 'stdev'),
+                    ('dominance', 'mean'), ('dominance', 'stdev'))
+    PATHS = ('valence', 'arousal', 'dominance', 'valence*arousal')
+    
+    def __init__(self, anew):
+        words = sorted(anew)
+        self.rows = dict((word, row) for row, word in enumerate(words))
+        self.not_found = len(words)
+        
+        self.values = np.zeros((len(words) + 1, len(self.ANEW_COLUMNS)), 
+                               dtype=np.float32)
+        
+        for row, word in enumerate(words):
+            self.values[row] = [float(anew[word][dimension][statistic]) 
+                                for dimension, statistic in self.ANEW_COLUMNS]
+        
+        self.values[self.not_found, 0] = 5
+        
+        # the exact Decimal scores of each row, for the 'decimal' precision
+        self.decimal_scores = [anew_scores(anew[word]['valence']['mean'],
+                                           anew[word]['arousal']['mean'],
+                                           anew[word]['dominance']['mean']) 
+                                for word in words]
+        self.decimal_scores.append(anew_scores(Decimal('5.'), Decimal('0'), 
+                                               Decimal('0')))
+    
+    def __len__(self):
+        return self.not_found
+    
+    def row_indices(self, sent_dict):
+        '''
+        Returns the table row of each word in the sentence: the row of the
+        word itself, else of its lemma, else the not found row.
+        '''
+        rows = self.rows
+        not_found = self.not_found
+        
+        return [rows.get(word, rows.get(lemma, not_found)) 
+                for word, lemma in zip(sent_dict['words'], sent_dict['lemmas'])]
+    
+    def tag_sentences(self, sentence_dicts, precision='decimal'):
+        '''
+        Sets the 'anew' paths of every sentence, scoring all of their words
+        at once. The 'decimal' precision gives exactly the Decimal weights of
+        tag_anew_sentence; 'float' gives float32 weights.
+        '''
+        row_lists = [self.row_indices(sent) for sent in sentence_dicts]
+        
+        if precision == 'decimal':
+            for sent_dict, rows in zip(sentence_dicts, row_lists):
+                columns = zip(*[self.decimal_scores[row] for row in rows])
+                
+                if not columns:
+                    columns = [()] * len(self.PATHS)
+                
+                sent_dict['anew'] = dict((path, list(column)) for path, column 
+                                          in zip(self.PATHS, columns))
+            return
+        
+        lengths = [len(rows) for rows in row_lists]
+        rows = np.fromiter(itertools.chain(*row_lists), dtype=np.intp, 
+                           count=sum(lengths))
+        
+        means = self.values[rows]
+        scores = anew_scores(means[:, 0], means[:, 2], means[:, 4])
+        
+        # split the scores of all the words back into sentences
+        offsets = np.cumsum(lengths)[:-1]
+        path_splits = [np.split(score, offsets) for score in scores]
+        
+        for index, sent_dict in enumerate(sentence_dicts):
+            sent_dict['anew'] = dict((path, list(splits[index])) for path, splits 
+                                      in zip(self.PATHS, path_splits))
+
+def read_anew_table(path):
+    '''
+    Reads the ANEW.txt file into an AnewTable.
+    '''
+    return AnewTable(read_anew_db(path))
+
 def read_sentiwordnet(path):
     '''
     Returns a dictionary keyed by the pair (POS, offset). Each value is also
@@ -379,21 +1342,106 @@ def read_sentiwordnet(path):
     
     return sentiwordnet
 
-def read_anew_db(path):
+def sentiwordnet_key(pos, offset):
     '''
-    Reads the ANEW.txt file into a dictionary keyed by word. Each value is
-    also a dictionary with the following structure:
-    {'abduction' : { 'word_num' : 621,
-    'frequency' : 1,
-    'valence' : { 'mean' : 2.76,
-    'stdev' : 2.06},
-    'arousal' : { 'mean' : 5.53,
-    'stdev' : 2.43},
-    'dominance' : { 'mean' : 3.49,
-    'stdev' : 2.38}
-    }
-    }
-    >>> anew = read_anew_db('/Users/bpg/cslu/affect/word_data/anew_all.txt')
+    Packs a SentiWordNet (POS, offset) pair into a single integer, which
+    sorts by POS and then offset.
+    
+    >>> sentiwordnet_key('a', 1005286)
+    416612832998L
+    '''
+    return (long(ord(pos)) << 32) | offset
+
+class SentiWordNetTable:
+    '''
+    The SentiWordNet scores in a binary NumPy table, mapped into memory
+    rather than parsed. Rows are sorted by sentiwordnet_key, so a synset is
+    found by binary search. Like the dictionary from read_sentiwordnet, it is
+    indexed by (POS, offset) pairs, but only has 'pos' and 'neg' scores.
+    '''
+    DTYPE = np.dtype([('key', '<i8'), ('pos', '<f4'), ('neg', '<f4')])
+    
+    def __init__(self, table_path):
+        self.table = np.load(table_path, mmap_mode='r')
+        self.keys = self.table['key']
+    
+    def __len__(self):
+        return len(self.table)
+    
+    def row(self, synset_pair):
+        '''
+        Returns the row index of a (POS, offset) pair, or None.
+        '''
+        key = sentiwordnet_key(*synset_pair)
+        row = int(np.searchsorted(self.keys, key))
+        
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        
+        return None
+    
+    def __contains__(self, synset_pair):
+        return self.row(synset_pair) is not None
+    
+    def __getitem__(self, synset_pair):
+        row = self.row(synset_pair)
+        
+        if row is None:
+            raise KeyError(synset_pair)
+        
+        return {'pos' : float(self.table['pos'][row]), 
+                'neg' : float(self.table['neg'][row])}
+
+def convert_sentiwordnet(text_path, table_path):
+    '''
+    Converts the SentiWordNet text file to the binary table read by
+    SentiWordNetTable.
+    '''
+    log.info('converting %s to %s' % (text_path, table_path))
+    sentiwordnet = read_sentiwordnet(text_path)
+    
+    table = np.zeros(len(sentiwordnet), dtype=SentiWordNetTable.DTYPE)
+    
+    for row, (synset_pair, values) in enumerate(sentiwordnet.iteritems()):
+        table[row] = (sentiwordnet_key(*synset_pair), values['pos'], values['neg'])
+    
+    table.sort(order='key')
+    
+    # write to a temporary file first, so that the table is never left half
+    # written
+    temp_path = '%s.%i.tmp' % (table_path, os.getpid())
+    np.save(open(temp_path, 'wb'), table)
+    os.rename(temp_path, table_path)
+
+def read_sentiwordnet_table(path):
+    '''
+    Returns a SentiWordNetTable for the SentiWordNet text file at path,
+    first converting it to a binary table alongside it (path with a .npy
+    extension) if there isn't one or it is older than the text file.
+    '''
+    table_path = os.path.splitext(path)[0] + '.npy'
+    
+    if not os.path.exists(table_path) or \
+            os.path.getmtime(table_path) < os.path.getmtime(path):
+        convert_sentiwordnet(path, table_path)
+    
+    return SentiWordNetTable(table_path)
+
+def read_anew_db(path):
+    '''
+    Reads the ANEW.txt file into a dictionary keyed by word. Each value is
+    also a dictionary with the following structure:
+    {'abduction' : { 'word_num' : 621,
+    'frequency' : 1,
+    'valence' : { 'mean' : 2.76,
+    'stdev' : 2.06},
+    'arousal' : { 'mean' : 5.53,
+    'stdev' : 2.43},
+    'dominance' : { 'mean' : 3.49,
+    'stdev' : 2.38}
+    }
+    }
+    >>> anew = read_anew_db('/Users/bpg/cslu/affect/word_data/anew_all.txt')
     >>> anew['village'] == {'arousal': {'stdev': Decimal('1.87'), 'mean': Decimal('4.08')}, 'word_num': 477, 'valence': {'stdev': Decimal('1.34'), 'mean': Decimal('5.92')}, 'frequency': 72, 'dominance': {'stdev': Decimal('1.74'), 'mean': Decimal('4.94')}}
     True
     '''
@@ -424,7 +1472,14 @@ def read_anew_db(path):
 def read_word_lists(list_directory):
     '''
     Reads all files with a .list extension in a specified directory. Returns
-    a dictionary keyed by words, where the values are lists of tags.
+    a dictionary keyed by words, where the values are lists of tags. Each
+    tag is listed once per word, even if the word is in its list under
+    several senses.
+    
+    >>> lists = read_word_lists(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ...                                      '..', 'word_data', 'lists'))
+    >>> sorted(lists['pass'])
+    ['negwords', 'poswords']
     '''
     words = {}
     
@@ -432,15 +1487,226 @@ def read_word_lists(list_directory):
         if list_filename.endswith('.list'):
             tag = os.path.splitext(list_filename)[0]
             for word in open(os.path.join(list_directory, list_filename)):
-                word = word.strip().lower()
+                word = word_list_entry(word)
                 
                 if word not in words:
                     words[word] = [tag]
-                else:
+                elif tag not in words[word]:
                     words[word].append(tag)
     
     return words
 
+def word_list_entry(line):
+    '''
+    Normalizes a line of a word list: lowercases it and strips the General
+    Inquirer sense suffix, if any.
+    
+    >>> word_list_entry('PASS#_10 \\n')
+    'pass'
+    >>> word_list_entry('BANISH#1')
+    'banish'
+    '''
+    return line.split('#')[0].strip().lower()
+
+def word_list_patterns(entry):
+    '''
+    Returns the token sequences that a word list entry matches. Words of
+    multi-word entries are separated by spaces or underscores, and hyphenated
+    entries also match their parts as separate tokens. A trailing * makes
+    the last token a prefix.
+    
+    >>> word_list_patterns('cold_feet')
+    [('cold', 'feet')]
+    >>> word_list_patterns('fed-up')
+    [('fed-up',), ('fed', 'up')]
+    '''
+    tokens = tuple(entry.replace('_', ' ').split())
+    patterns = [tokens]
+    
+    if '-' in entry:
+        split_tokens = tuple(' '.join(tokens).replace('-', ' ').split())
+        
+        if split_tokens and split_tokens != tokens:
+            patterns.append(split_tokens)
+    
+    return [pattern for pattern in patterns if pattern]
+
+class WordListMatcher:
+    '''
+    A trie of the word list entries, keyed by token, that tags a whole
+    sentence in one left to right pass. At each word, the longest entry
+    starting there is matched, each of its tokens matching either a word or
+    its lemma (words before lemmas, and whole tokens before prefixes). The
+    entry's tags are added once and the pass continues after it; a word with
+    no match is tagged 'none', as in tag_sentence_for_lists.
+    
+    >>> matcher = WordListMatcher({'fear' : ['Fwordls'], 'cold_feet' : ['Fwordls'], 'frighten*' : ['Fwordls'], 'pass' : ['negwords']})
+    >>> sent = {'words' : ['cold', 'feet', 'and', 'frightening', 'fears'], 'lemmas' : ['cold', 'foot', 'and', 'frightening', 'fear']}
+    >>> matcher.tag_sentence(sent)
+    >>> sent['lists']
+    ['Fwordls', 'none', 'Fwordls', 'Fwordls']
+    >>> matcher.add(('pass',), ['negwords', 'poswords'])
+    >>> sent = {'words' : ['pass', 'the', 'salt'], 'lemmas' : ['pass', 'the', 'salt']}
+    >>> matcher.tag_sentence(sent)
+    >>> sent['lists']
+    ['negwords', 'poswords', 'none', 'none']
+    '''
+    
+    def __init__(self, word_lists):
+        # each node is a list of [children by token, children by prefix, tags]
+        self.root = [{}, {}, None]
+        
+        for entry, tags in word_lists.iteritems():
+            for pattern in word_list_patterns(entry):
+                self.add(pattern, tags)
+    
+    @classmethod
+    def from_trie(cls, root):
+        '''
+        Makes a WordListMatcher from the root node of another one's trie,
+        which is plain lists and dicts, e.g. as read from a cache.
+        '''
+        if not (isinstance(root, list) and len(root) == 3):
+            raise ValueError('not the root of a word list trie')
+        
+        matcher = cls.__new__(cls)
+        matcher.root = root
+        
+        return matcher
+    
+    def add(self, pattern, tags):
+        '''
+        Adds the tags of an entry to the end of its token pattern, skipping
+        those it already has.
+        '''
+        node = self.root
+        
+        for index, token in enumerate(pattern):
+            if index == len(pattern) - 1 and token.endswith('*'):
+                children = node[1]
+                token = token.rstrip('*')
+            else:
+                children = node[0]
+            
+            node = children.setdefault(token, [{}, {}, None])
+        
+        if node[2] is None:
+            node[2] = []
+        
+        node[2].extend([tag for tag in tags if tag not in node[2]])
+    
+    def longest_match(self, words, lemmas, start):
+        '''
+        Returns (length, tags) for the longest entry starting at words[start],
+        or (0, None) if there is none.
+        '''
+        best = (0, None)
+        stack = [(self.root, start)]
+        
+        while stack:
+            node, index = stack.pop()
+            
+            if node[2] is not None and index - start > best[0]:
+                best = (index - start, node[2])
+            
+            if index == len(words):
+                continue
+            
+            forms = [words[index]]
+            if lemmas[index] != words[index]:
+                forms.append(lemmas[index])
+            
+            # push in reverse order of preference, so that the preferred
+            # match of each length is found first
+            children = []
+            for form in forms:
+                if form in node[0]:
+                    children.append(node[0][form])
+            for form in forms:
+                for end in xrange(len(form), 0, -1):
+                    if form[:end] in node[1]:
+                        children.append(node[1][form[:end]])
+            
+            stack.extend([(child, index + 1) for child in reversed(children)])
+        
+        return best
+    
+    def tag_sentence(self, sent_dict):
+        '''
+        Adds 'lists' tags to a lemmatized sentence.
+        '''
+        words = sent_dict['words']
+        lemmas = sent_dict['lemmas']
+        tags = []
+        index = 0
+        
+        while index < len(words):
+            length, match_tags = self.longest_match(words, lemmas, index)
+            
+            if length:
+                tags.extend(match_tags)
+                index += length
+            else:
+                tags.append('none')
+                index += 1
+        
+        sent_dict['lists'] = tags
+
+def read_word_list_matcher(list_directory, cache_path=None):
+    '''
+    Returns a WordListMatcher for the .list files in a directory. The trie
+    of the matcher is cached as a compressed pickle at cache_path
+    (WORD_LIST_CACHE by default), which is rebuilt when the directory or any
+    of its lists change, or if it can't be read.
+    
+    >>> import tempfile
+    >>> cache_path = os.path.join(tempfile.mkdtemp(), 'word_list_cache')
+    >>> list_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ...                               '..', 'word_data', 'lists')
+    >>> built = read_word_list_matcher(list_directory, cache_path)
+    >>> cached = read_word_list_matcher(list_directory, cache_path)
+    >>> cached.root == built.root
+    True
+    >>> open(cache_path, 'wb').write('not a cache')
+    >>> read_word_list_matcher(list_directory, cache_path).root == built.root
+    True
+    '''
+    cache_path = cache_path or WORD_LIST_CACHE
+    list_filenames = sorted([filename for filename in os.listdir(list_directory)
+                                if filename.endswith('.list')])
+    # the version covers changes to how the lists are read
+    fingerprint = [ANNOTATION_VERSION, os.path.realpath(list_directory)]
+    
+    for filename in list_filenames:
+        stat = os.stat(os.path.join(list_directory, filename))
+        fingerprint.append((filename, stat.st_mtime, stat.st_size))
+    
+    try:
+        data = open(cache_path, 'rb').read()
+        cached_fingerprint, root = cPickle.loads(zlib.decompress(data))
+        
+        if cached_fingerprint == fingerprint:
+            return WordListMatcher.from_trie(root)
+    except Exception, e:
+        # a missing or unreadable cache is just rebuilt
+        pass
+    
+    log.info('compiling word lists in %s' % list_directory)
+    matcher = WordListMatcher(read_word_lists(list_directory))
+    
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        
+        temp_path = '%s.%i.tmp' % (cache_path, os.getpid())
+        data = cPickle.dumps((fingerprint, matcher.root), cPickle.HIGHEST_PROTOCOL)
+        open(temp_path, 'wb').write(zlib.compress(data))
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError), e:
+        log.warning('could not cache word lists in %s: %s' % (cache_path, e))
+    
+    return matcher
+
 def tag_sentence_for_lists(sent_dict, lists_dict):
     '''
     Tries to tag sentences using the lists. If the word isn't found, look for
@@ -493,175 +1759,604 @@ def read_pos_sentence(sentence_id, story, pos_directory):
     
     return {'words' : word_list, 'pos' : pos_list}
 
-def create_symbol_table(sentence_dicts, key, filename):
+class SymbolTable:
     '''
-    Writes a symbol table in the AT&T format to the specified filename.
+    Interns symbols as integer labels, numbered from 1 in the order they are
+    first seen (0 is epsilon in OpenFst). FSTs are written with these labels
+    so that fstcompile doesn't need to read a symbol table. The table is
+    still written out in the AT&T format for the kernel tools. A table that
+    is read back only has new symbols appended to it, so that the labels,
+    and so the compiled FSTs, of the other symbols stay the same.
+    
+    >>> table = SymbolTable(['the', 'cat'])
+    >>> table.labels(['the', 'dog', 'the'])
+    [1, 3, 1]
+    >>> len(table), table.symbols
+    (3, ['the', 'cat', 'dog'])
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'symbol_table.tsv')
+    >>> table.write(path)
+    >>> SymbolTable.read(path).labels(['bird', 'dog'])
+    [4, 3]
     '''
-    symbols = set()
     
-    counter = 1
+    def __init__(self, symbols=()):
+        self.ids = {}
+        self.symbols = []
+        
+        for symbol in symbols:
+            self.intern(symbol)
+    
+    def intern(self, symbol):
+        '''
+        Returns the label for symbol, adding it to the table if it's new.
+        '''
+        try:
+            return self.ids[symbol]
+        except KeyError:
+            self.symbols.append(symbol)
+            self.ids[symbol] = len(self.symbols)
+            
+            return self.ids[symbol]
+    
+    def labels(self, symbols):
+        '''
+        Returns the list of labels for a sequence of symbols.
+        '''
+        return [self.intern(symbol) for symbol in symbols]
+    
+    @classmethod
+    def read(cls, filename):
+        '''
+        Reads a symbol table written by write(). Raises a ValueError if its
+        labels aren't numbered 1, 2, ..., n.
+        '''
+        table = cls()
+        
+        for line in open(filename):
+            if line.strip() == '':
+                continue
+            
+            symbol, label = line.rstrip('\n').rsplit('\t', 1)
+            
+            if table.intern(symbol) != int(label):
+                raise ValueError('%s is not numbered from 1 in order' % filename)
         
-    f = open(filename, 'w')
+        return table
+    
+    def write(self, filename):
+        '''
+        Writes the symbol table in the AT&T format to the specified filename.
+        '''
+        temp_filename = '%s.%i.tmp' % (filename, os.getpid())
+        f = open(temp_filename, 'w')
+        
+        for label, symbol in enumerate(self.symbols):
+            f.write('%s\t%i\n' % (symbol, label+1))
+        
+        f.close()
+        os.rename(temp_filename, filename)
+    
+    def __len__(self):
+        return len(self.symbols)
+
+def create_symbol_table(sentence_dicts, key, filename):
+    '''
+    Writes a symbol table in the AT&T format to the specified filename.
+    Returns the SymbolTable.
+    '''
+    symbol_table = SymbolTable()
     
-    # write words
     for sent_dict in sentence_dicts:
-        for word in sent_dict[key]:
-            if word not in symbols:
-                f.write('%s\t%i\n' % (word, counter))
-                
-                symbols.add(word)
-                counter += 1
+        symbol_table.labels(sent_dict[key])
     
-    f.close()
+    symbol_table.write(filename)
+    
+    return symbol_table
 
-def write_simple_symbol_table(symbols, filename):
-    f = open(filename, 'w')
-    symbol_set = set(symbols)
-    for index, symbol in enumerate(symbol_set):
-        f.write('%s\t%i\n' % (symbol, index))
+def write_many_simple_fsts(sent_dicts, key, basepath='./', jobs=1, batch=False, cache=None, split_options={}):
+    '''
+    Writes a list of fsts to a directory using a SimpleFSTWriter. First
+    creates a directory by appending key to basepath and writes over any
+    existing directory. Then, calls write_simple_fst for each sentence, using
+    a pool of jobs processes. If batch is True, all of the FSTs are instead
+    compiled at once by compile_fst_batch. If an FSTCache is passed,
+    unchanged FSTs are copied from it instead of compiled. Finally writes a
+    symbol file, an FST list file and the SVM input files, passing
+    split_options through to write_svm_input.
+    '''
+    writer = SimpleFSTWriter(key, basepath, jobs=jobs, batch=batch, cache=cache,
+                             split_options=split_options)
+    writer.write(sent_dicts)
+    writer.close()
+
+def write_many_multipath_fsts(sent_dicts, key, weight_range=None, split_values=False, basepath='./', jobs=1, batch=False, cache=None, split_options={}):
+    '''
+    Writes a list of fsts to a directory using a MultipathFSTWriter. First
+    creates a directory by appending key to basepath and writes over any
+    existing directory. Then, calls write_multipath_fst for each sentence,
+    using a pool of jobs processes. If batch is True, all of the FSTs are
+    instead compiled at once by compile_fst_batch. If an FSTCache is passed,
+    unchanged FSTs are copied from it instead of compiled. Finally writes a
+    symbol file, an FST list file and the SVM input files, passing
+    split_options through to write_svm_input.
+    '''
+    writer = MultipathFSTWriter(key, basepath, weight_range=weight_range, 
+                                split_values=split_values, jobs=jobs, 
+                                batch=batch, cache=cache, 
+                                split_options=split_options)
+    writer.write(sent_dicts)
+    writer.close()
+
+class FSTWriter:
+    '''
+    Writes the FSTs of one type to basepath + key/fsts, numbered from 1, a
+    chunk of sentences at a time, so that the whole corpus never needs to be
+    in memory. Only the emotion of each sentence is kept until close(),
+    which writes the symbol table, the FST list and the SVM input files.
+    Subclasses define fst_job(), which returns the arguments for job_function,
+    and write_text(), which writes an FST without compiling it.
+    
+    FSTs are compiled by a pool of jobs processes as each chunk is written.
+    If batch is True, only the text is written and close() compiles all of
+    them with compile_fst_batch. A pool can be passed in to share it between
+    writers.
+    
+    The symbol table of the last run is kept and only appended to, so that
+    a new word doesn't change the labels of the others: it is stored with
+    the FST cache, as symbols/KEY.tsv, or if there is no cache it is the
+    symbol_table.tsv already in the output directory.
+    '''
+    job_function = None
+    
+    def __init__(self, key, basepath='./', jobs=1, batch=False, cache=None, split_options={}, pool=None):
+        self.key = key
+        self.fst_directory = os.path.join(basepath + key, 'fsts')
+        self.symbol_path = os.path.join(self.fst_directory, 'symbol_table.tsv')
+        self.far_path = os.path.join(basepath + key, key + '.far')
+        
+        self.jobs = jobs
+        self.batch = batch
+        self.cache = cache
+        self.split_options = split_options
+        
+        self.emotions = []
+        self.failures = []
+        
+        self.pool = pool
+        self.own_pool = False
+        
+        if not pool and jobs > 1 and not batch:
+            self.pool = multiprocessing.Pool(jobs)
+            self.own_pool = True
         
+        if cache:
+            self.stored_symbol_path = os.path.join(cache.directory, 'symbols', key + '.tsv')
+        else:
+            self.stored_symbol_path = self.symbol_path
+        
+        self.stored_symbol_table = read_stored_symbol_table(self.stored_symbol_path)
+        
+        if os.path.exists(self.fst_directory):
+            shutil.rmtree(self.fst_directory)
+        
+        os.makedirs(self.fst_directory)
     
-    f.close()
+    def fst_basepath(self, sent_no):
+        return os.path.join(self.fst_directory, str(sent_no+1))
+    
+    def write(self, sentence_dicts):
+        '''
+        Writes (and unless batch is True, compiles) an FST for each sentence.
+        '''
+        fst_jobs = []
+        
+        for sent_dict in sentence_dicts:
+            fst_basepath = self.fst_basepath(len(self.emotions))
+            
+            fst_jobs.append(self.fst_job(sent_dict, fst_basepath))
+            self.emotions.append(sent_dict['emotion'])
+        
+        if self.batch:
+            for fst_job in fst_jobs:
+                self.write_text(*fst_job)
+        else:
+            self.failures.extend(run_fst_jobs(self.job_function, fst_jobs, 
+                                              self.jobs, self.pool))
+    
+    def compile_batch(self):
+        fst_basepaths = [self.fst_basepath(sent_no) for sent_no in range(len(self.emotions))]
+        
+        return compile_fst_batch(fst_basepaths, self.jobs, cache=self.cache)
+    
+    def close(self):
+        '''
+        Compiles a batch, if needed, and writes the symbol table, the FST list
+        and the SVM input files. Returns the basepaths of any FSTs that failed
+        to compile.
+        '''
+        self.symbol_table.write(self.symbol_path)
+        
+        if self.stored_symbol_path != self.symbol_path:
+            try:
+                if not os.path.exists(os.path.dirname(self.stored_symbol_path)):
+                    os.makedirs(os.path.dirname(self.stored_symbol_path))
+                
+                self.symbol_table.write(self.stored_symbol_path)
+            except (IOError, OSError), e:
+                log.warning('could not store the symbol table: %s' % e)
+        
+        if self.batch and self.emotions:
+            self.failures.extend(self.compile_batch())
+        
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+        
+        write_fst_list(len(self.emotions), self.fst_directory, self.key)
+        write_svm_input(self.emotions, self.fst_directory, **self.split_options)
+        
+        return self.failures
 
-def write_many_simple_fsts(sent_dicts, key, basepath='./'):
+class SimpleFSTWriter(FSTWriter):
     '''
-    Writes a list of fsts to a directory. First creates a directory by
-    appending key to basepath and writes over any existing directory.
-    Then, writes a symbol file. Then, calls write_simple_fst for each 
-    sentence. Finally creates an FST list file.
+    Writes a single unweighted path through sentence_dict[key] for each
+    sentence. Symbols are interned as they are seen, after those of the
+    stored symbol table. In batch mode, the symbols are also written to a
+    strings file for farcompilestrings.
     '''
-    fst_directory = os.path.join(basepath + key, 'fsts')
-    symbol_path = os.path.join(fst_directory, "symbol_table.tsv")
     
-    if os.path.exists(fst_directory):
-        shutil.rmtree(fst_directory)
+    def __init__(self, key, basepath='./', **kwargs):
+        FSTWriter.__init__(self, key, basepath, **kwargs)
         
-    os.makedirs(fst_directory)
+        self.symbol_table = self.stored_symbol_table or SymbolTable()
+        self.job_function = simple_fst_job
+        
+        if self.batch:
+            self.strings_path = os.path.join(self.fst_directory, 'sentences.strings')
+            self.strings_file = open(self.strings_path, 'w')
+            self.empty_strings = False
     
-    create_symbol_table(sent_dicts, key, symbol_path)
+    def fst_job(self, sent_dict, fst_basepath):
+        symbols = sent_dict[self.key]
+        
+        if self.batch:
+            self.strings_file.write(' '.join(symbols) + '\n')
+            self.empty_strings = self.empty_strings or not symbols
+        
+        return (self.symbol_table.labels(symbols), fst_basepath, self.cache)
+    
+    def write_text(self, labels, fst_basepath, cache):
+        write_simple_fst_text(labels, fst_basepath)
+    
+    def compile_batch(self):
+        fst_basepaths = [self.fst_basepath(sent_no) for sent_no in range(len(self.emotions))]
+        
+        self.strings_file.close()
+        
+        if self.empty_strings:
+            strings_path = None
+        else:
+            strings_path = self.strings_path
+        
+        return compile_fst_batch(fst_basepaths, self.jobs, cache=self.cache,
+                                 symbol_path=self.symbol_path,
+                                 strings_path=strings_path, far_path=self.far_path)
+
+class MultipathFSTWriter(FSTWriter):
+    '''
+    Writes one weighted path per value list in sentence_dict[key] for each
+    sentence. The symbol table is made from the path names of the first
+    sentence, and the negative and split versions of them.
+    '''
     
-    for sent_no, sent_dict in enumerate(sent_dicts):
-        fst_basepath = os.path.join(fst_directory, str(sent_no+1))
+    def __init__(self, key, basepath='./', weight_range=None, split_values=False, **kwargs):
+        FSTWriter.__init__(self, key, basepath, **kwargs)
         
-        write_simple_fst(sent_dict[key], symbol_path, fst_basepath)
+        self.weight_range = weight_range
+        self.split_values = split_values
+        self.symbol_table = None
+        self.encoding = None
+        self.job_function = multipath_fst_job
+    
+    def create_symbol_table(self, path_names):
+        symbols = sorted(path_names)
+        # add negative values for all symbols, even though they might not all be used
+        neg_symbols = ['neg_%s' % symbol for symbol in symbols]
+        symbols.extend(neg_symbols)
         
-    write_fst_list(sent_dicts, fst_directory, key)
-    write_svm_input(sent_dicts, fst_directory)
+        if self.split_values:
+            split_symbols = []
+            for symbol in symbols:
+                split_symbols.append('%s_pos' % symbol)
+                split_symbols.append('%s_neg' % symbol)
+                split_symbols.append('%s_neutral' % symbol)
+            
+            self.symbol_table = SymbolTable(split_symbols)
+        else:
+            self.symbol_table = SymbolTable(symbols)
+    
+    def fst_job(self, sent_dict, fst_basepath):
+        if self.symbol_table is None:
+            self.create_symbol_table(sent_dict[self.key].keys())
+            self.encoding = MultipathEncoding(self.symbol_table, 
+                                              sent_dict[self.key].keys(),
+                                              self.weight_range, 
+                                              self.split_values)
+        
+        return (sent_dict[self.key], fst_basepath, self.encoding, self.cache)
+    
+    def write_text(self, paths, fst_basepath, encoding, cache):
+        encoding.write(paths, fst_basepath)
+    
+    def close(self):
+        if self.symbol_table is None:
+            self.symbol_table = SymbolTable()
+        
+        return FSTWriter.close(self)
+
+def read_stored_symbol_table(path):
+    '''
+    Returns the SymbolTable stored at path, or None if there isn't one or
+    it can't be read.
+    '''
+    if not os.path.exists(path):
+        return None
+    
+    try:
+        return SymbolTable.read(path)
+    except (IOError, ValueError), e:
+        log.warning('ignoring the symbol table at %s: %s' % (path, e))
+        return None
 
-def write_simple_fst(symbols, symbol_path, fst_basepath):
+def create_fst_writer(fst_type, basepath='./', **kwargs):
     '''
-    Writes a simple fst containing a single path of symbols with no weights.
+    Returns a SimpleFSTWriter for the SIMPLE_FST_TYPES, or a
+    MultipathFSTWriter for the others.
+    '''
+    if fst_type in SIMPLE_FST_TYPES:
+        return SimpleFSTWriter(fst_type, basepath, **kwargs)
+    else:
+        return MultipathFSTWriter(fst_type, basepath, **kwargs)
+
+def write_simple_fst(labels, fst_basepath, cache=None):
+    '''
+    Writes a simple fst containing a single path of labels with no weights.
     A text representation of the FST is written to fst_path + ".txt" and then
-    it is compile into a binary using fstcompile.
+    it is compile into a binary using fstcompile. Returns the fstcompile
+    return code.
+    '''
+    write_simple_fst_text(labels, fst_basepath)
+    
+    return compile_fst(fst_basepath, cache)
+
+def write_simple_fst_text(labels, fst_basepath):
+    '''
+    Writes the text representation of a simple fst (a single path of labels
+    with no weights) to fst_basepath + ".txt".
     '''
     fst = open(fst_basepath + ".txt", "w")
     
     # write arcs with each word
     state = 1
-    for symbol in symbols:
-        write_arc(fst, state, state+1, symbol, symbol)
+    for label in labels:
+        write_arc(fst, state, state+1, label, label)
         state += 1
     
     # write final state
     fst.write(str(state))
     fst.close()
-    
-    compile_fst(fst_basepath, symbol_path)
 
-def write_many_multipath_fsts(sent_dicts, key, weight_range=None, split_values=False, basepath='./'):
+def simple_fst_job(job_args):
     '''
-    Writes a list of fsts to a directory. First creates a directory by
-    appending key to basepath and writes over any existing directory.
-    Then, writes a symbol file. Then, calls write_multipath_fst for each 
-    sentence. Finally creates an FST list file.
+    Pool worker for write_simple_fst. job_args is a tuple of
+    (labels, fst_basepath, cache). Returns (fst_basepath, return code).
     '''
-    fst_directory = os.path.join(basepath + key, 'fsts')
-    symbol_path = os.path.join(fst_directory, "symbol_table.tsv")
-    
-    if os.path.exists(fst_directory):
-        shutil.rmtree(fst_directory)
-        
-    os.makedirs(fst_directory)
-    
-    
-    symbols = sent_dicts[0][key].keys()
-    # add negative values for all symbols, even though they might not all be used
-    neg_symbols = ['neg_%s' % symbol for symbol in symbols]
-    symbols.extend(neg_symbols)
-    
-    if split_values:
-        split_symbols = set()
-        for symbol in symbols:
-            split_symbols.add('%s_pos' % symbol)
-            split_symbols.add('%s_neg' % symbol)
-            split_symbols.add('%s_neutral' % symbol)
-        
-        write_simple_symbol_table(split_symbols, symbol_path)
-    else:
-        write_simple_symbol_table(symbols, symbol_path)
+    labels, fst_basepath, cache = job_args
     
-    for sent_no, sent_dict in enumerate(sent_dicts):
-        fst_basepath = os.path.join(fst_directory, str(sent_no+1))
-        
-        write_multipath_fst(sent_dict[key], fst_basepath, symbol_path, 
-                    weight_range=weight_range, split_values=split_values)
-        
-    write_fst_list(sent_dicts, fst_directory, key)
-    write_svm_input(sent_dicts, fst_directory)
+    return fst_basepath, write_simple_fst(labels, fst_basepath, cache)
 
-def write_multipath_fst(paths, fst_basepath, symbol_path, weight_range=None, split_values=False):
+def write_multipath_fst(paths, fst_basepath, symbol_table, weight_range=None, split_values=False, cache=None):
     '''
-    
+    Writes an fst with one weighted path per key in paths, all sharing the
+    start and final states, and compiles it with fstcompile. Returns the
+    fstcompile return code.
     '''
-    first_state = 1
-    last_state = 0
-    current_state = 1
+    write_multipath_fst_text(paths, fst_basepath, symbol_table, weight_range, split_values)
     
-    fst = open(fst_basepath + ".txt", "w")
+    return compile_fst(fst_basepath, cache)
+
+def write_multipath_fst_text(paths, fst_basepath, symbol_table, weight_range=None, split_values=False):
+    '''
+    Writes the text representation of a multipath fst to fst_basepath + ".txt",
+    labelling the arcs using symbol_table.
+    '''
+    encoding = MultipathEncoding(symbol_table, paths.keys(), weight_range, 
+                                 split_values)
+    encoding.write(paths, fst_basepath)
+
+class MultipathEncoding:
+    '''
+    Turns the paths of a sentence into the text of a multipath FST. Each path
+    is a list of values, one arc each. The label ids of every path name and
+    the midpoint of weight_range are looked up once, rather than per arc, and
+    each FST is written at once.
+    
+    If split_values is False, negative values are written as their absolute
+    value on the neg_ version of the path's label. Otherwise each value is
+    labelled _pos, _neg or _neutral by which side of the midpoint of
+    weight_range it is on, and weighted by its distance from it.
+    
+    >>> encoding = MultipathEncoding(SymbolTable(['pos', 'neg_pos']), ['pos'])
+    >>> encoding.fst_text({'pos' : [0.5, -0.25, 0]})
+    '1\\t2\\t1\\t1\\t0.5\\n2\\t3\\t2\\t2\\t0.25\\n3\\t0\\t1\\t1\\t0\\n0'
+    '''
     
-    for path_name, path in paths.iteritems():
-        for index, value in enumerate(path):
+    def __init__(self, symbol_table, path_names, weight_range=None, split_values=False):
+        self.split_values = split_values
+        self.labels = {}
+        
+        # the labels are kept as text, ready to be written
+        for path_name in path_names:
             if split_values:
-                midpoint = float(sum(weight_range)) / 2
-                
+                symbols = ['%s_pos' % path_name, '%s_neg' % path_name, 
+                           '%s_neutral' % path_name]
+            else:
+                symbols = [path_name, 'neg_%s' % path_name]
+            
+            self.labels[path_name] = tuple([str(symbol_table.ids[symbol]) 
+                                            for symbol in symbols])
+        
+        if split_values:
+            self.midpoint = float(sum(weight_range)) / 2
+            self.decimal_midpoint = Decimal(str(self.midpoint))
+            
+            # weight text by value text, since a weight depends only on it
+            self.split_weights = {}
+    
+    def arcs(self, path_name, path):
+        '''
+        Returns the (label, weight text) pair of each value in a path.
+        '''
+        arcs = []
+        
+        if self.split_values:
+            pos_label, neg_label, neutral_label = self.labels[path_name]
+            midpoint = self.midpoint
+            split_weights = self.split_weights
+            
+            for value in path:
                 if value < midpoint:
-                    label = '%s_neg' % path_name
+                    label = neg_label
                 elif value > midpoint:
-                    label = '%s_pos' % path_name
+                    label = pos_label
                 else:
-                    label = '%s_neutral' % path_name
+                    label = neutral_label
                 
-                weight = abs(Decimal(str(value)) - Decimal(str(midpoint)))
-            else:
+                value_text = str(value)
+                
+                if value_text not in split_weights:
+                    weight = abs(Decimal(value_text) - self.decimal_midpoint)
+                    
+                    # as in write_arc, zero weights are written as 0
+                    split_weights[value_text] = weight == 0 and '0' or str(weight)
+                
+                arcs.append((label, split_weights[value_text]))
+        else:
+            pos_label, neg_label = self.labels[path_name]
+            
+            for value in path:
                 if value < 0:
-                    weight = abs(value)
-                    label = 'neg_%s' % path_name
+                    arcs.append((neg_label, str(abs(value))))
+                elif value == 0:
+                    arcs.append((pos_label, '0'))
                 else:
-                    weight = value
-                    label = path_name
-            
-            if index == len(path) - 1:
-                # if it's the last arc, connect to the last_state, instead of
-                # state + 1
-                write_arc(fst, current_state, last_state, label, label, weight=weight)
-            elif index == 0:
-                # write the first arc
-                write_arc(fst, first_state, current_state+1, label, label, weight=weight)
-            else:
-                write_arc(fst, current_state, current_state+1, label, label, weight=weight)
+                    arcs.append((pos_label, str(value)))
+        
+        return arcs
+    
+    def fst_text(self, paths):
+        '''
+        Returns the text of the FST for a dict of paths. Every path starts at
+        state 1 and ends at the final state 0, and the states in between are
+        numbered in the order the arcs are written.
+        '''
+        first_state = '1'
+        last_state = '0'
+        current_state = 1
+        
+        lines = []
+        
+        for path_name, path in paths.iteritems():
+            arcs = self.arcs(path_name, path)
+            last_index = len(arcs) - 1
             
-            current_state += 1
+            # the text of current_state and current_state + 1
+            start_state = str(current_state)
+            
+            for index, (label, weight) in enumerate(arcs):
+                next_state = str(current_state + 1)
+                
+                if index == last_index:
+                    # if it's the last arc, connect to the last_state, instead
+                    # of state + 1
+                    lines.append('\t'.join((start_state, last_state, label, label, weight)))
+                elif index == 0:
+                    lines.append('\t'.join((first_state, next_state, label, label, weight)))
+                else:
+                    lines.append('\t'.join((start_state, next_state, label, label, weight)))
+                
+                start_state = next_state
+                current_state += 1
         
-    fst.write(str(last_state))
-    fst.close()
+        lines.append(last_state)
+        
+        return '\n'.join(lines)
+    
+    def write(self, paths, fst_basepath):
+        '''
+        Writes the FST for a dict of paths to fst_basepath + ".txt".
+        '''
+        fst = open(fst_basepath + ".txt", "w")
+        fst.write(self.fst_text(paths))
+        fst.close()
+
+def multipath_fst_job(job_args):
+    '''
+    Pool worker for MultipathFSTWriter. job_args is a tuple of
+    (paths, fst_basepath, MultipathEncoding, cache). Writes and compiles the
+    FST and returns (fst_basepath, return code).
+    '''
+    paths, fst_basepath, encoding, cache = job_args
+    
+    encoding.write(paths, fst_basepath)
     
-    compile_fst(fst_basepath, symbol_path)
+    return fst_basepath, compile_fst(fst_basepath, cache)
+
+def run_fst_jobs(job_function, fst_jobs, jobs=1, pool=None):
+    '''
+    Runs job_function on each tuple in fst_jobs using a pool of jobs worker
+    processes (or serially if jobs is 1). An existing pool may be passed in,
+    in which case it is left open. job_function must return a pair
+    (fst_basepath, return code). Every sentence whose FST failed to compile
+    is logged, and the list of failed basepaths is returned.
+    '''
+    own_pool = False
+    
+    if jobs > 1 and len(fst_jobs) > 1:
+        if not pool:
+            pool = multiprocessing.Pool(jobs)
+            own_pool = True
+        
+        chunksize = max(1, len(fst_jobs) / (jobs * 4))
+        results = pool.imap_unordered(job_function, fst_jobs, chunksize)
+    else:
+        results = itertools.imap(job_function, fst_jobs)
+    
+    failures = []
+    
+    for fst_basepath, returncode in results:
+        if returncode != 0:
+            log.error('fstcompile failed with return code %s for %s.txt' % 
+                      (returncode, fst_basepath))
+            failures.append(fst_basepath)
+    
+    if own_pool:
+        pool.close()
+        pool.join()
+    
+    if failures:
+        log.error('%i of %i FSTs failed to compile' % (len(failures), len(fst_jobs)))
+    else:
+        log.debug('compiled %i FSTs' % len(fst_jobs))
+    
+    return sorted(failures)
 
 def write_arc(f, start_state, end_state, input_label, output_label, weight=None):
     '''
     Writes a line to the text FST file with a weight if specified.
     '''
-    arc_fields = [str(start_state), str(end_state), input_label, output_label]
+    arc_fields = [str(start_state), str(end_state), str(input_label), str(output_label)]
     
     if weight == 0:
         arc_fields.append('0')
@@ -670,18 +2365,286 @@ def write_arc(f, start_state, end_state, input_label, output_label, weight=None)
     
     f.write('\t'.join(arc_fields) + '\n')
 
-def compile_fst(fst_basepath, symbol_path):
+def compile_fst(fst_basepath, cache=None):
     '''
-    Calls fstcompile using the specified symbol table.
+    Calls fstcompile on an FST with integer labels. Returns the return code
+    of fstcompile, or None if it could not be run at all. If an FSTCache is
+    passed and it already holds this FST, the FST is copied from the cache
+    instead and 0 is returned.
     '''
+    if cache:
+        cache_key = cache.key(fst_basepath + ".txt")
+        
+        if cache.fetch(cache_key, fst_basepath + ".fst"):
+            return 0
+    
     parameters = [ "fstcompile", 
-                   "--arc_type=log",
-                   "--isymbols=%s" % symbol_path, 
-                   "--osymbols=%s" % symbol_path, 
+                   "--arc_type=%s" % FST_ARC_TYPE,
                    fst_basepath + ".txt",
                    fst_basepath + ".fst"]
     
-    subprocess.call(parameters)
+    try:
+        returncode = subprocess.call(parameters)
+    except OSError, e:
+        log.error('unable to run fstcompile: %s' % e)
+        return None
+    
+    if cache and returncode == 0:
+        cache.store(cache_key, fst_basepath + ".fst")
+    
+    return returncode
+
+def compile_fst_batch(fst_basepaths, jobs=1, cache=None, symbol_path=None, strings_path=None, far_path=None):
+    '''
+    Compiles every fst_basepath + ".txt" into fst_basepath + ".fst" with a
+    constant number of processes, rather than one fstcompile per sentence.
+    The OpenFst Python bindings (pywrapfst) are used in-process if they are
+    installed. Otherwise, if strings_path, symbol_path and far_path are given
+    (i.e. every FST is a single unweighted path, written as a line of
+    symbols in strings_path), the strings are compiled into one archive at
+    far_path with farcompilestrings and unpacked with farextract. Failing
+    both, it falls back to a pool of jobs fstcompile processes. An FSTCache
+    is consulted per FST or, for the archive, for the whole archive. Returns
+    the list of basepaths that failed to compile.
+    '''
+    try:
+        import pywrapfst
+    except ImportError, e:
+        pywrapfst = None
+    
+    if pywrapfst:
+        return compile_fsts_in_process(pywrapfst, fst_basepaths, cache)
+    elif far_path and symbol_path and strings_path:
+        return compile_fst_archive(fst_basepaths, symbol_path, strings_path, 
+                                   far_path, cache)
+    else:
+        log.warning('pywrapfst is unavailable and these FSTs cannot be '
+                    'compiled as strings. Running fstcompile per sentence.')
+        fst_jobs = [(basepath, cache) for basepath in fst_basepaths]
+        return run_fst_jobs(compile_fst_job, fst_jobs, jobs)
+
+def compile_fst_job(job_args):
+    '''
+    Pool worker for compile_fst. job_args is a tuple of 
+    (fst_basepath, cache). Returns (fst_basepath, return code).
+    '''
+    fst_basepath, cache = job_args
+    
+    return fst_basepath, compile_fst(fst_basepath, cache)
+
+def compile_fsts_in_process(pywrapfst, fst_basepaths, cache=None):
+    '''
+    Compiles text FSTs with the pywrapfst bindings. Returns the list of
+    basepaths that failed to compile.
+    '''
+    failures = []
+    
+    for fst_basepath in fst_basepaths:
+        if cache:
+            cache_key = cache.key(fst_basepath + '.txt')
+            
+            if cache.fetch(cache_key, fst_basepath + '.fst'):
+                continue
+        
+        compiler = pywrapfst.Compiler(arc_type=FST_ARC_TYPE)
+        compiler.write(open(fst_basepath + '.txt').read())
+        
+        try:
+            compiler.compile().write(fst_basepath + '.fst')
+        except pywrapfst.FstError, e:
+            log.error('unable to compile %s.txt: %s' % (fst_basepath, e))
+            failures.append(fst_basepath)
+            continue
+        
+        if cache:
+            cache.store(cache_key, fst_basepath + '.fst')
+    
+    log.debug('compiled %i FSTs in process' % len(fst_basepaths))
+    
+    return failures
+
+def compile_fst_archive(fst_basepaths, symbol_path, strings_path, far_path, cache=None):
+    '''
+    Compiles each line of symbols in strings_path into a single FST archive
+    at far_path using farcompilestrings and then extracts
+    fst_basepath + ".fst" for each one using farextract. All of the
+    basepaths must be in the same directory and be named 1, 2, ..., n in the
+    order of the lines, and no line may be empty. farcompilestrings
+    generates those keys zero-padded to the same width, since an archive's
+    keys must be in increasing order as strings; the extracted files are
+    renamed to drop the padding. If an FSTCache is passed and it
+    holds an archive for the same strings, only farextract is run. Returns
+    the list of basepaths that failed to compile.
+    '''
+    fst_directory = os.path.dirname(fst_basepaths[0])
+    key_width = len(str(len(fst_basepaths)))
+    
+    compile_args = ['farcompilestrings',
+                    '--arc_type=%s' % FST_ARC_TYPE,
+                    '--entry_type=line',
+                    '--token_type=symbol',
+                    '--symbols=%s' % symbol_path,
+                    '--keep_symbols=false',
+                    '--generate_keys=%i' % key_width,
+                    strings_path,
+                    far_path]
+    
+    extract_args = ['farextract',
+                    '--filename_prefix=%s' % os.path.join(fst_directory, ''),
+                    '--filename_suffix=.fst',
+                    far_path]
+    
+    steps = [compile_args, extract_args]
+    
+    if cache:
+        cache_key = cache.key(strings_path, symbol_path)
+        
+        if cache.fetch(cache_key, far_path):
+            steps.remove(compile_args)
+    
+    for arguments in steps:
+        log.info(' '.join(arguments))
+        
+        try:
+            returncode = subprocess.call(arguments)
+        except OSError, e:
+            log.error('unable to run %s: %s' % (arguments[0], e))
+            returncode = None
+        
+        if returncode != 0:
+            log.error('%s failed with return code %s' % (arguments[0], returncode))
+            return list(fst_basepaths)
+        
+        if cache and arguments is compile_args:
+            cache.store(cache_key, far_path)
+    
+    for number, basepath in enumerate(fst_basepaths):
+        extracted_path = os.path.join(fst_directory, '%0*i.fst' % (key_width, number + 1))
+        
+        if extracted_path != basepath + '.fst' and os.path.exists(extracted_path):
+            os.rename(extracted_path, basepath + '.fst')
+    
+    failures = [basepath for basepath in fst_basepaths 
+                    if not os.path.exists(basepath + '.fst')]
+    
+    for basepath in failures:
+        log.error('%s.fst was not extracted from %s' % (basepath, far_path))
+    
+    return failures
+
+class FSTCache:
+    '''
+    A directory of compiled FSTs, keyed by a SHA-1 hash of the FST text,
+    FST_ARC_TYPE and, for FSTs compiled from symbols rather than integer
+    labels, the symbol table contents, so an FST is only recompiled when one
+    of those changes. Entries are stored as directory/ab/abcdef....fst.
+    Fetching an entry touches it, and prune() removes the least recently used
+    entries once the directory is larger than max_bytes.
+    '''
+    
+    def __init__(self, directory, max_bytes=1024*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        
+        # symbol table digests, keyed by (path, mtime, size)
+        self.symbol_digests = {}
+    
+    def key(self, text_path, symbol_path=None):
+        '''
+        Returns the cache key for the FST text at text_path, compiled with the
+        symbol table at symbol_path if one is needed.
+        '''
+        digest = hashlib.sha1(FST_ARC_TYPE)
+        
+        if symbol_path:
+            digest.update(self.symbol_digest(symbol_path))
+        
+        digest.update(open(text_path, 'rb').read())
+        
+        return digest.hexdigest()
+    
+    def symbol_digest(self, symbol_path):
+        '''
+        Returns a digest of the symbol table contents. Each symbol table is
+        only hashed once per process, unless it is rewritten.
+        '''
+        stat = os.stat(symbol_path)
+        symbol_key = (symbol_path, stat.st_mtime, stat.st_size)
+        
+        if symbol_key not in self.symbol_digests:
+            self.symbol_digests[symbol_key] = hashlib.sha1(open(symbol_path, 'rb').read()).digest()
+        
+        return self.symbol_digests[symbol_key]
+    
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.fst')
+    
+    def fetch(self, key, fst_path):
+        '''
+        Copies the cached FST for key to fst_path. Returns False if there is
+        no such entry.
+        '''
+        entry_path = self.entry_path(key)
+        
+        try:
+            shutil.copyfile(entry_path, fst_path)
+        except IOError:
+            return False
+        
+        # mark the entry as recently used
+        os.utime(entry_path, None)
+        
+        return True
+    
+    def store(self, key, fst_path):
+        '''
+        Adds a compiled FST to the cache. The entry is written to a temporary
+        file and renamed, so concurrent workers never see a partial FST.
+        '''
+        entry_path = self.entry_path(key)
+        entry_directory = os.path.dirname(entry_path)
+        
+        try:
+            if not os.path.exists(entry_directory):
+                os.makedirs(entry_directory)
+            
+            temp_path = '%s.%i.tmp' % (entry_path, os.getpid())
+            shutil.copyfile(fst_path, temp_path)
+            os.rename(temp_path, entry_path)
+        except (IOError, OSError), e:
+            log.warning('unable to cache %s: %s' % (fst_path, e))
+    
+    def prune(self):
+        '''
+        Removes the least recently used entries until the cache is no larger
+        than max_bytes. The symbol tables stored by the FST writers are kept.
+        '''
+        entries = []
+        total_bytes = 0
+        
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            if dirpath == self.directory and 'symbols' in dirnames:
+                dirnames.remove('symbols')
+            
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+        
+        entries.sort()
+        removed = 0
+        
+        while total_bytes > self.max_bytes and entries:
+            mtime, size, path = entries.pop(0)
+            os.remove(path)
+            
+            total_bytes -= size
+            removed += 1
+        
+        if removed:
+            log.debug('removed %i FSTs from the cache at %s' % (removed, self.directory))
 
 def lemmatize_word(word, pos=None):
     '''
@@ -696,18 +2659,23 @@ def lemmatize_word(word, pos=None):
     'bring'
     
     '''
-    lemmatizer = nltk.stem.WordNetLemmatizer()
-    
     if pos:
         wordnet_pos_tag = wordnet_pos(pos)
     else:
         wordnet_pos_tag = None
     
+    return lemma_cache.get((word, wordnet_pos_tag), lemmatize_uncached, 
+                           word, wordnet_pos_tag)
+
+def lemmatize_uncached(word, wordnet_pos_tag):
+    '''
+    Does the WordNet lookups for lemmatize_word, which memoizes the results.
+    '''
     if wordnet_pos_tag:
-        return lemmatizer.lemmatize(word, wordnet_pos_tag)
+        return LEMMATIZER.lemmatize(word, wordnet_pos_tag)
     else:
         for tag in ['a', 'r', 'n', 'v']:
-            root = lemmatizer.lemmatize(word, tag)
+            root = LEMMATIZER.lemmatize(word, tag)
             if root != word:
                 return root
     
@@ -725,9 +2693,7 @@ def stem_word(word):
     >>> stem_word('really')
     'realli'
     '''
-    porter = nltk.PorterStemmer()
-    
-    return porter.stem(word)
+    return stem_cache.get(word, STEMMER.stem, word)
     
 def wordnet_pos(pos_tag):
     '''
@@ -743,7 +2709,7 @@ def wordnet_pos(pos_tag):
     
     return prefixes.get(pos_tag[:2])
 
-def write_fst_list(sentence_dicts, fst_directory, key):
+def write_fst_list(sentence_count, fst_directory, key):
     """
     Writes an fst list file one level above fst_directory for all of the sentences. 
     Line numbers should correspond to sentence indices in list of dicts. 
@@ -752,7 +2718,7 @@ def write_fst_list(sentence_dicts, fst_directory, key):
     
     f = open(list_file_path, 'w')
     
-    for index in range(1, len(sentence_dicts)+1):
+    for index in range(1, sentence_count+1):
         filename = os.path.join(fst_directory, str(index) + '.fst')
         f.write('%s\n' % os.path.realpath(filename))
         
@@ -760,26 +2726,33 @@ def write_fst_list(sentence_dicts, fst_directory, key):
         
     f.close()
 
-def write_svm_input(sentence_dicts, fst_directory, train_percentage=0.8):
+def write_svm_input(emotions, fst_directory, train_percentage=0.8, seed=None, stratify=False, folds=None):
     '''
-    Writes test and train files for input to LIBSVM. Also writes a file 
-    containing all of the sentences
+    Writes test and train files for input to LIBSVM, given the emotion of
+    each sentence. Also writes a file containing all of the sentences. The
+    split is drawn by split_indices with the given seed, so passing the same
+    seed for every FST type gives the same split. The seed is written to
+    sentences.seed. If folds is set, sentences.fold<i>.train and
+    sentences.fold<i>.test are also written for each of the folds.
     '''
     train_path = os.path.join(fst_directory, 'sentences.train')
     test_path = os.path.join(fst_directory, 'sentences.test')
     all_path = os.path.join(fst_directory, 'sentences.all')
+    seed_path = os.path.join(fst_directory, 'sentences.seed')
     
-    training_size = int(round(train_percentage*len(sentence_dicts)))
-    train_list = random.sample(sentence_dicts, training_size)
+    if seed is None:
+        seed = random.randrange(2**31)
     
+    lines = ['%s %i:1.0\n' % (emotion, index+1) for index, emotion in enumerate(emotions)]
+    
+    train_indices = split_indices(emotions, train_percentage, seed, stratify)
     
     train_file = open(train_path, 'w')
     test_file  = open(test_path, 'w')
     all_file = open(all_path, 'w')
     
-    for index, sent_dict in enumerate(sentence_dicts): 
-        line = '%s %i:1.0\n' % (sent_dict['emotion'], index+1)
-        if sent_dict in train_list:
+    for index, line in enumerate(lines): 
+        if index in train_indices:
             train_file.write(line)
         else:
             test_file.write(line)
@@ -789,6 +2762,91 @@ def write_svm_input(sentence_dicts, fst_directory, train_percentage=0.8):
     train_file.close()
     test_file.close()
     all_file.close()
+    
+    if folds:
+        fold_numbers = fold_indices(emotions, folds, seed, stratify)
+        
+        for fold in range(folds):
+            train_file = open(os.path.join(fst_directory, 'sentences.fold%i.train' % fold), 'w')
+            test_file = open(os.path.join(fst_directory, 'sentences.fold%i.test' % fold), 'w')
+            
+            for line, fold_number in zip(lines, fold_numbers):
+                if fold_number == fold:
+                    test_file.write(line)
+                else:
+                    train_file.write(line)
+            
+            train_file.close()
+            test_file.close()
+    
+    seed_file = open(seed_path, 'w')
+    seed_file.write('%i\n' % seed)
+    seed_file.close()
+
+def split_indices(emotions, train_percentage=0.8, seed=None, stratify=False):
+    '''
+    Returns the set of sentence indices to train on, given the emotion of
+    each sentence. train_percentage of the sentences are drawn at random
+    using seed. If stratify is True, train_percentage of each emotion is
+    drawn instead, so that the training set has the same class balance.
+    
+    >>> emotions = [1, 1, 1, 1, 2, 2, 2, 2, 2, 2]
+    >>> split_indices(emotions, 0.5, seed=1) == split_indices(emotions, 0.5, seed=1)
+    True
+    >>> len(split_indices(emotions, 0.5, seed=1))
+    5
+    >>> sorted([emotions[index] for index in split_indices(emotions, 0.5, seed=1, stratify=True)])
+    [1, 1, 2, 2, 2]
+    '''
+    rng = random.Random(seed)
+    train_indices = set()
+    
+    for group in index_groups(emotions, stratify):
+        training_size = int(round(train_percentage*len(group)))
+        train_indices.update(rng.sample(group, training_size))
+    
+    return train_indices
+
+def fold_indices(emotions, folds, seed=None, stratify=False):
+    '''
+    Returns a list with the fold number [0, folds) of each sentence, for 
+    k-fold cross validation. Sentences are shuffled using seed and dealt out
+    to the folds in turn. If stratify is True, each emotion is dealt out
+    separately, so every fold has the same class balance.
+    
+    >>> emotions = [1, 1, 1, 2, 2, 2]
+    >>> sorted(fold_indices(emotions, 3, seed=1))
+    [0, 0, 1, 1, 2, 2]
+    >>> [sorted([emotions[index] for index, fold in enumerate(fold_indices(emotions, 3, 1, True)) if fold == f]) for f in range(3)]
+    [[1, 2], [1, 2], [1, 2]]
+    '''
+    rng = random.Random(seed)
+    fold_numbers = [None] * len(emotions)
+    count = 0
+    
+    for group in index_groups(emotions, stratify):
+        rng.shuffle(group)
+        
+        for index in group:
+            fold_numbers[index] = count % folds
+            count += 1
+    
+    return fold_numbers
+
+def index_groups(emotions, stratify=False):
+    '''
+    Returns lists of sentence indices: one per emotion (in sorted order of
+    emotion) if stratify is True, otherwise a single list of all of them.
+    '''
+    if not stratify:
+        return [range(len(emotions))]
+    
+    groups = {}
+    
+    for index, emotion in enumerate(emotions):
+        groups.setdefault(emotion, []).append(index)
+    
+    return [groups[emotion] for emotion in sorted(groups)]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stem_corpus.py
+
+Stems every .agree file under a directory with the Porter stemmer, in
+parallel, writing NAME.agreestem files to a mirror of the directory. This is
+how alm_data/consolidated-stemmed is made from alm_data/consolidated.
+"""
+
+import sys
+import optparse
+import logging
+import os
+import time
+import multiprocessing
+import porter_stemmer
+
+LOG_LEVELS = {'debug': logging.DEBUG,
+               'info': logging.INFO,
+            'warning': logging.WARNING,
+              'error': logging.ERROR,
+           'critical': logging.CRITICAL}
+
+logging.basicConfig()
+log = logging.getLogger('stem-corpus')
+
+def main():
+    usage = """%prog [options] INPUT_DIRECTORY OUTPUT_DIRECTORY
+            """
+    
+    opt_parser = optparse.OptionParser(usage=usage)
+    
+    opt_parser.add_option("-l", "--log_level", action="store",
+                        default='info', dest="log_level",
+                        help="Log level: debug, info, warning, error, critical")
+    opt_parser.add_option("-j", "--jobs", action='store', type=int,
+                        default=multiprocessing.cpu_count(), dest='jobs',
+                        help="Number of files to stem at once. Default: %default")
+    opt_parser.add_option("-f", "--force", action='store_true', default=False,
+                        dest='force', help="Stem every file, even if its "
+                        "output is newer than it.")
+    
+    options, arguments = opt_parser.parse_args()
+    
+    if len(arguments) != 2:
+        opt_parser.error('expected an input and an output directory')
+    
+    log.setLevel(LOG_LEVELS[options.log_level])
+    
+    stem_corpus(arguments[0], arguments[1], jobs=options.jobs,
+                force=options.force)
+
+def stem_corpus(input_directory, output_directory, jobs=1, force=False):
+    '''
+    Stems each .agree file under input_directory whose output doesn't exist
+    or is older than it, and logs the throughput. Returns the number of
+    tokens stemmed.
+    '''
+    file_jobs = []
+    skipped = 0
+    
+    for input_path, output_path in find_agree_files(input_directory, output_directory):
+        if not force and os.path.exists(output_path) and \
+                os.path.getmtime(output_path) >= os.path.getmtime(input_path):
+            skipped += 1
+        else:
+            file_jobs.append((input_path, output_path))
+    
+    log.info('stemming %i files, skipping %i which are up to date' %
+             (len(file_jobs), skipped))
+    
+    start = time.time()
+    
+    if jobs > 1 and len(file_jobs) > 1:
+        pool = multiprocessing.Pool(jobs)
+        token_counts = pool.map(stem_agree_file_job, file_jobs)
+        pool.close()
+        pool.join()
+    else:
+        token_counts = [stem_agree_file_job(file_job) for file_job in file_jobs]
+    
+    elapsed = time.time() - start
+    tokens = sum(token_counts)
+    
+    log.info('stemmed %i tokens in %i files in %.2fs (%.0f tokens/s)' %
+             (tokens, len(file_jobs), elapsed, tokens / max(elapsed, 1e-6)))
+    
+    return tokens
+
+def find_agree_files(input_directory, output_directory):
+    '''
+    Returns (input path, output path) pairs for every .agree file under
+    input_directory, where the output path is the same relative path under
+    output_directory with an .agreestem extension.
+    '''
+    pairs = []
+    
+    for (dirpath, dirnames, filenames) in os.walk(input_directory):
+        relative_directory = os.path.relpath(dirpath, input_directory)
+        
+        for filename in sorted(filenames):
+            if filename.endswith('.agree'):
+                pairs.append((os.path.join(dirpath, filename),
+                              os.path.normpath(os.path.join(output_directory,
+                                                            relative_directory,
+                                                            filename + 'stem'))))
+    
+    return pairs
+
+def stem_agree_line(line):
+    '''
+    Stems the text of an id@emotion@text line, leaving the id and emotion
+    fields as they are. Returns the stemmed line and its number of tokens.
+    
+    >>> stem_agree_line('9@6@Then he got up and clambered out of the cave.\\n')
+    ('9@6@then he got up and clamber out of the cave.\\n', 10)
+    '''
+    fields = line.split('@', 2)
+    
+    if len(fields) < 3:
+        return line, 0
+    
+    text = fields[2]
+    tokens = len(porter_stemmer.WORD_PATTERN.findall(text))
+    
+    return '@'.join(fields[:2] + [porter_stemmer.stem_line(text)]), tokens
+
+def stem_agree_file(input_path, output_path):
+    '''
+    Writes the stemmed lines of an .agree file to output_path. Returns the
+    number of tokens stemmed.
+    '''
+    output_directory = os.path.dirname(output_path)
+    
+    if output_directory and not os.path.exists(output_directory):
+        try:
+            os.makedirs(output_directory)
+        except OSError, e:
+            # another process may have just made it
+            if not os.path.isdir(output_directory):
+                raise
+    
+    tokens = 0
+    temp_path = '%s.%i.tmp' % (output_path, os.getpid())
+    output = open(temp_path, 'w')
+    
+    for line in open(input_path):
+        stemmed_line, line_tokens = stem_agree_line(line)
+        output.write(stemmed_line)
+        tokens += line_tokens
+    
+    output.close()
+    os.rename(temp_path, output_path)
+    
+    log.debug('stemmed %s' % input_path)
+    
+    return tokens
+
+def stem_agree_file_job(file_job):
+    '''
+    Calls stem_agree_file on an (input path, output path) pair, for use with
+    multiprocessing.Pool.
+    '''
+    return stem_agree_file(*file_job)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        import doctest
+        doctest.testmod(verbose=False)
+    else:
+        main()
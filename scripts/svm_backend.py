@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+svm_backend.py
+
+Trains SVMs on precomputed kernel matrices in the same process, with
+scikit-learn or libsvm's Python bindings, instead of running svm-train on a
+kernel file for each C value and fold.
+"""
+
+import sys
+import logging
+import numpy as np
+import make_kernels
+
+log = logging.getLogger('svm_backend')
+
+# in order of preference
+BACKENDS = ('sklearn', 'libsvm')
+
+# the fraction of a golden-section search's interval kept at each step
+GOLDEN_SECTION = (np.sqrt(5) - 1) / 2
+
+def find_backend(backend=None):
+    '''
+    Returns the name of the backend to use: the given one if it can be
+    imported, or else the first of BACKENDS that can be. Raises an
+    ImportError if none can.
+    '''
+    for name in (backend,) if backend else BACKENDS:
+        try:
+            import_backend(name)
+            return name
+        except ImportError, e:
+            log.debug('cannot import %s: %s' % (name, e))
+    
+    raise ImportError('cannot import %s to train SVMs in process' %
+                      ' or '.join((backend,) if backend else BACKENDS))
+
+def import_backend(backend):
+    '''
+    Returns scikit-learn's SVC class or libsvm's svmutil module.
+    '''
+    if backend == 'sklearn':
+        from sklearn.svm import SVC
+        return SVC
+    elif backend == 'libsvm':
+        try:
+            from libsvm import svmutil
+        except ImportError:
+            import svmutil
+        
+        return svmutil
+    
+    raise ImportError('unknown SVM backend %r' % backend)
+
+def read_gram_matrix(kernel_filename):
+    '''
+    Reads a LIBSVM precomputed kernel file (see
+    make_kernels.write_precomputed_kernel). Returns the labels of its
+    sentences and the square matrix of the kernel between them.
+    '''
+    labels, serials, rows = make_kernels.read_precomputed_kernel(kernel_filename)
+    
+    return labels, rows[:, np.array(serials) - 1]
+
+def kernel_folds(labels, folds, seed=None):
+    '''
+    Assigns each sentence to one of folds cross-validation folds, spreading
+    the sentences of each label evenly across them like svm-train -v.
+    Returns an array of fold numbers.
+    
+    >>> kernel_folds(['a', 'a', 'a', 'b', 'b', 'b'], 3, seed=1).tolist()
+    [0, 2, 1, 2, 0, 1]
+    '''
+    random = np.random.RandomState(seed)
+    fold_ids = np.zeros(len(labels), dtype=int)
+    labels = np.asarray(labels)
+    offset = 0
+    
+    for label in sorted(set(labels)):
+        indices = random.permutation(np.flatnonzero(labels == label))
+        fold_ids[indices] = (np.arange(len(indices)) + offset) % folds
+        offset += len(indices)
+    
+    return fold_ids
+
+def cross_validation_accuracy(kernel, labels, c, folds=5, fold_ids=None,
+                              backend=None, seed=None):
+    '''
+    Returns the cross-validation accuracy (%) of an SVM with cost c trained
+    on a square kernel matrix, like svm-train -t 4 -v folds. The folds are
+    made by kernel_folds unless fold_ids is given, which should be reused
+    across C values and kernels so that their accuracies are comparable.
+    
+    >>> kernel = np.array([[1, 1, 0, 0], [1, 1, 0, 0], [0, 0, 1, 1], [0, 0, 1, 1]])
+    >>> cross_validation_accuracy(kernel, ['a', 'a', 'b', 'b'], 1, folds=2)
+    100.0
+    '''
+    backend = find_backend(backend)
+    labels = np.asarray(labels)
+    
+    if fold_ids is None:
+        fold_ids = kernel_folds(labels, folds, seed)
+    
+    correct = 0
+    
+    for fold in np.unique(fold_ids):
+        train = np.flatnonzero(fold_ids != fold)
+        test = np.flatnonzero(fold_ids == fold)
+        
+        model = train_svm(kernel[np.ix_(train, train)], labels[train], c, backend)
+        predictions = predict_svm(model, kernel[np.ix_(test, train)])
+        correct += (np.asarray(predictions) == labels[test]).sum()
+    
+    return 100.0 * correct / len(labels)
+
+def train_svm(kernel, labels, c, backend=None):
+    '''
+    Trains an SVM with cost c on a square kernel matrix. Returns the model,
+    for predict_svm.
+    '''
+    backend = find_backend(backend)
+    
+    if len(set(labels)) == 1:
+        # neither backend trains on a single class
+        return ('constant', labels[0])
+    
+    if backend == 'sklearn':
+        model = import_backend(backend)(C=c, kernel='precomputed')
+        model.fit(kernel, labels)
+        return (backend, model)
+    
+    svmutil = import_backend(backend)
+    label_names = sorted(set(labels))
+    label_ids = dict([(label, i) for i, label in enumerate(label_names)])
+    
+    # precomputed rows start with 0:row number
+    problem = svmutil.svm_problem([label_ids[label] for label in labels],
+                                  svm_kernel_rows(kernel), isKernel=True)
+    model = svmutil.svm_train(problem, svmutil.svm_parameter('-t 4 -c %f -q' % c))
+    
+    return (backend, (model, label_names))
+
+def predict_svm(model, kernel_rows):
+    '''
+    Returns the predicted label of each row of the kernel between the test
+    sentences and the training sentences of the model.
+    '''
+    backend, model = model
+    
+    if backend == 'constant':
+        return [model] * len(kernel_rows)
+    elif backend == 'sklearn':
+        return model.predict(kernel_rows)
+    
+    svmutil = import_backend(backend)
+    model, label_names = model
+    
+    predictions = svmutil.svm_predict([0] * len(kernel_rows),
+                                      svm_kernel_rows(kernel_rows), model, '-q')[0]
+    
+    return [label_names[int(prediction)] for prediction in predictions]
+
+def adaptive_c_search(score, c_min=0.1, c_max=8.0, coarse_points=7, refinements=8):
+    '''
+    Searches for the c between c_min and c_max with the best score(c), such
+    as a cross-validation accuracy, with few evaluations: first
+    coarse_points values spaced evenly on a log scale, then a golden-section
+    search on the log scale between the neighbours of the best of those,
+    with refinements more evaluations. Returns the best c, its score, and a
+    dictionary of c -> score for every c evaluated.
+    
+    >>> best_c, best_score, scores = adaptive_c_search(lambda c: -np.log(c / 2) ** 2)
+    >>> round(best_c, 1), len(scores)
+    (2.0, 15)
+    '''
+    scores = {}
+    
+    def evaluate(log_c):
+        c = float(np.exp(log_c))
+        
+        if c not in scores:
+            scores[c] = score(c)
+            log.debug('c = %.4f: %s' % (c, scores[c]))
+        
+        return scores[c]
+    
+    grid = np.linspace(np.log(c_min), np.log(c_max), coarse_points)
+    best = int(np.argmax([evaluate(log_c) for log_c in grid]))
+    low = grid[max(best - 1, 0)]
+    high = grid[min(best + 1, len(grid) - 1)]
+    
+    # the two inner points of the interval; each step drops the part beyond
+    # the worse one and evaluates one new point
+    inner1 = high - GOLDEN_SECTION * (high - low)
+    inner2 = low + GOLDEN_SECTION * (high - low)
+    score1 = evaluate(inner1)
+    score2 = evaluate(inner2)
+    
+    for step in range(refinements - 2):
+        if score1 >= score2:
+            high, inner2, score2 = inner2, inner1, score1
+            inner1 = high - GOLDEN_SECTION * (high - low)
+            score1 = evaluate(inner1)
+        else:
+            low, inner1, score1 = inner1, inner2, score2
+            inner2 = low + GOLDEN_SECTION * (high - low)
+            score2 = evaluate(inner2)
+    
+    # the smallest of the best c values regularizes the most
+    best_c = max(scores, key=lambda c: (scores[c], -c))
+    
+    return best_c, scores[best_c], scores
+
+def regularization_path(kernel, labels, c_values, folds=5, fold_ids=None, 
+                        warm_start=True, tolerance=1e-3, seed=None):
+    '''
+    Cross-validates an SVM for each of c_values on a square kernel matrix
+    with solve_dual, visiting the C values in increasing order. The binary
+    one-vs-one problems of each fold are made once, and with warm_start
+    each is solved from the previous C's solution, with the variables at
+    the old bound moved to the new one, which is usually close to the new
+    solution. Returns the
+    accuracy (%) for each C in the order given, and the total number of
+    solver iterations.
+    
+    >>> kernel = np.array([[2, 1, 0, 0], [1, 2, 0, 0], [0, 0, 2, 1], [0, 0, 1, 2]])
+    >>> regularization_path(kernel, ['a', 'a', 'b', 'b'], [1, 0.1], folds=2)[0]
+    [100.0, 100.0]
+    '''
+    labels = np.asarray(labels)
+    order = sorted(range(len(c_values)), key=lambda i: c_values[i])
+    correct = np.zeros(len(c_values))
+    iterations = 0
+    
+    if fold_ids is None:
+        fold_ids = kernel_folds(labels, folds, seed)
+    
+    for fold in np.unique(fold_ids):
+        train = np.flatnonzero(fold_ids != fold)
+        test = np.flatnonzero(fold_ids == fold)
+        problems = binary_problems(kernel, labels, train)
+        test_kernel = kernel[np.ix_(test, train)] + 1.0
+        alphas = [None] * len(problems)
+        previous_c = None
+        
+        for i in order:
+            c = float(c_values[i])
+            votes = {}
+            
+            for p, (label1, label2, indices, signs, hessian) in enumerate(problems):
+                alpha = alphas[p]
+                
+                if alpha is not None and warm_start:
+                    # bounded variables usually stay at the bound
+                    alpha = np.where(alpha >= previous_c, c, alpha)
+                else:
+                    alpha = None
+                
+                alpha, problem_iterations = solve_dual(hessian, c, alpha, tolerance)
+                alphas[p] = alpha
+                iterations += problem_iterations
+                
+                decisions = np.dot(test_kernel[:, indices], alpha * signs)
+                votes[label1, label2] = decisions > 0
+            
+            predictions = one_vs_one_votes(votes, len(test))
+            correct[i] += (predictions == labels[test]).sum()
+            previous_c = c
+    
+    return (100.0 * correct / len(labels)).tolist(), iterations
+
+def binary_problems(kernel, labels, train):
+    '''
+    Returns the one-vs-one binary problems of the training sentences, as
+    (first label, second label, indices into train, signs, Hessian) tuples,
+    where the sentences of the first label have sign 1 and the Hessian is
+    Q[i, j] = sign[i] * sign[j] * (K[i, j] + 1).
+    '''
+    problems = []
+    train_labels = labels[train]
+    label_names = sorted(set(train_labels))
+    
+    for a, label1 in enumerate(label_names):
+        for label2 in label_names[a + 1:]:
+            indices = np.flatnonzero((train_labels == label1) | (train_labels == label2))
+            signs = np.where(train_labels[indices] == label1, 1.0, -1.0)
+            sentences = train[indices]
+            hessian = (kernel[np.ix_(sentences, sentences)] + 1.0) * np.outer(signs, signs)
+            problems.append((label1, label2, indices, signs, hessian))
+    
+    return problems
+
+def one_vs_one_votes(votes, count):
+    '''
+    Returns the label with the most votes for each of count sentences, from
+    a dictionary of (first label, second label) -> whether each sentence is
+    of the first label. Ties go to the first label in sorted order, as in
+    libsvm.
+    
+    >>> one_vs_one_votes({('a', 'b'): np.array([True, False])}, 2).tolist()
+    ['a', 'b']
+    '''
+    label_names = sorted(set([label for pair in votes for label in pair]))
+    counts = np.zeros((len(label_names), count), dtype=int)
+    
+    for (label1, label2), first in votes.iteritems():
+        counts[label_names.index(label1)] += first
+        counts[label_names.index(label2)] += ~first
+    
+    return np.array(label_names)[counts.argmax(axis=0)]
+
+def solve_dual(hessian, c, alpha=None, tolerance=1e-3, max_iterations=None):
+    '''
+    Solves the dual of a binary SVM whose bias is folded into the kernel as
+    K + 1, min 1/2 a'Qa - sum(a) subject to 0 <= a <= c, by greedy
+    coordinate descent: each iteration minimizes over the variable whose
+    projected gradient is largest, until none is larger than tolerance.
+    Starts from alpha if it's given. Returns the solution and the number of
+    iterations.
+    
+    >>> hessian = np.array([[2.0, -1.0], [-1.0, 2.0]])
+    >>> alpha, iterations = solve_dual(hessian, 10)
+    >>> np.round(alpha, 3).tolist()
+    [1.0, 1.0]
+    >>> solve_dual(hessian, 10, alpha)[1]
+    0
+    '''
+    size = len(hessian)
+    max_iterations = max_iterations or 100 * size + 1000
+    diagonal = hessian.diagonal()
+    
+    if alpha is None:
+        alpha = np.zeros(size)
+        gradient = -np.ones(size)
+    else:
+        alpha = np.clip(alpha, 0, c)
+        gradient = np.dot(hessian, alpha) - 1
+    
+    for iteration in xrange(max_iterations):
+        # the gradient can't move a variable out of its bounds
+        projected = np.where(((alpha <= 0) & (gradient > 0)) | 
+                             ((alpha >= c) & (gradient < 0)), 0, gradient)
+        i = np.abs(projected).argmax()
+        
+        if abs(projected[i]) <= tolerance:
+            return alpha, iteration
+        
+        value = min(max(alpha[i] - gradient[i] / diagonal[i], 0), c)
+        gradient += (value - alpha[i]) * hessian[i]
+        alpha[i] = value
+    
+    log.warning('solve_dual stopped after %i iterations' % max_iterations)
+    
+    return alpha, max_iterations
+
+def svm_kernel_rows(kernel):
+    '''
+    Returns the rows of a kernel matrix as lists for libsvm's svm_problem
+    and svm_predict, each starting with its 1-based row number.
+    '''
+    return [[i + 1] + row for i, row in enumerate(np.asarray(kernel, dtype=float).tolist())]
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        import doctest
+        doctest.testmod(verbose=False)
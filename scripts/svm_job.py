@@ -18,7 +18,8 @@ class SVMJob:
     LEAVE_ONE_OUT_CV = -1
     
     c_value = property(doc="SVM cost parameter.")
-    kernel_path = property(doc="OpenKernel kernel file")
+    kernel_path = property(doc="OpenKernel kernel file, or LIBSVM precomputed kernel file if precomputed is set")
+    precomputed = property(doc="Whether kernel_path is a LIBSVM precomputed kernel (svm-train -t 4), which is trained instead of training_file")
     cross_validation = property(doc="Either an integer for n-fold cross "
                             "validation or LEAVE_ONE_OUT for leave-one-out cv.")
     training_file = property(doc="Training file")
@@ -32,6 +33,7 @@ class SVMJob:
     def __init__(self, c=1, kernel=None, cross_validation=None, training_file=None, output_basename=None):
         self.c_value = c
         self.kernel_path = kernel
+        self.precomputed = False
         self.cross_validation = cross_validation
         self.training_file = training_file
         self.output_basename = output_basename
@@ -102,26 +104,28 @@ class SVMJob:
         '''
         Generates the arguments sutiable for either svm-train or leave_one_out_svm.py
         '''
-        if not self.c_value or not self.training_file or not self.kernel_path:
+        if not self.c_value or not self.kernel_path or \
+                not (self.training_file or self.precomputed):
             raise ValueError('c, training_file and kernel path must all be set.')
         
+        if self.precomputed:
+            # the kernel rows are the training data
+            kernel_args = ['-t', '4']
+            training_file = self.kernel_path
+        else:
+            kernel_args = ['-k', 'openkernel', '-K', self.kernel_path]
+            training_file = self.training_file
+        
         if self.cross_validation == self.LEAVE_ONE_OUT_CV:
-            return [self.training_file, self.temp_directory,
-                                        '-c', str(self.c_value),
-                                        '-k', 'openkernel',
-                                        '-K', self.kernel_path]
+            return [training_file, self.temp_directory,
+                                   '-c', str(self.c_value)] + kernel_args
         elif type(self.cross_validation) == int:
-            return ['-c', '%f' % self.c_value,
-                    '-k', 'openkernel',
-                    '-K', self.kernel_path,
-                    '-v', '%i' % self.cross_validation,
-                    self.training_file]
+            return ['-c', '%f' % self.c_value] + kernel_args + \
+                   ['-v', '%i' % self.cross_validation,
+                    training_file]
         else:
             # just train the data, without any validation
-            return ['-c', '%f' % c,
-                    '-k', 'openkernel',
-                    '-K', self.kernel_path,
-                    self.training_file]
+            return ['-c', '%f' % self.c_value] + kernel_args + [training_file]
     
     def get_accuracy(self):
         '''
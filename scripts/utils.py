@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 def classification_baseline(svm_filename):
     """
     Takes as input an svm filename and returns the baseline for classification
@@ -30,3 +32,52 @@ def filter_classes(svm_filename, filtered_svm_filename, classes):
     
     svm_out.close()
 
+class LRUCache:
+    """
+    A bounded memo table which discards the least recently used entry once it
+    holds max_size entries. Counts hits and misses.
+    
+    >>> cache = LRUCache(2)
+    >>> cache.get('a', len, 'a'), cache.get('bb', len, 'bb'), cache.get('a', len, 'a')
+    (1, 2, 1)
+    >>> cache.get('ccc', len, 'ccc')
+    3
+    >>> 'bb' in cache, 'a' in cache
+    (False, True)
+    >>> cache.hits, cache.misses
+    (1, 3)
+    """
+    
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, function, *args):
+        """
+        Returns the value stored for key. On a miss, function(*args) is
+        called and its result stored.
+        """
+        try:
+            value = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = function(*args)
+            self.misses += 1
+            
+            if len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+        
+        self.entries[key] = value
+        
+        return value
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __str__(self):
+        return '%i hits, %i misses, %i entries' % (self.hits, self.misses, len(self))
@@ -14,6 +14,7 @@ import numpy as np
 import subprocess
 import pdb
 import os
+import svm_backend
 
 LOG_LEVELS = {'debug': logging.DEBUG,
                'info': logging.INFO,
@@ -24,7 +25,7 @@ LOG_LEVELS = {'debug': logging.DEBUG,
 log = logging.getLogger('vary_c')
 
 def main():
-    usage = """%prog C_BEGIN C_END C_STEP OUTPUT_FILE SVM_ARGS [options]
+    usage = """%prog C_BEGIN C_END C_STEP OUTPUT_FILE [--path|--search] SVM_ARGS [options]
             """
     
     c_begin = float(sys.argv[1])
@@ -33,15 +34,78 @@ def main():
     output_basename = sys.argv[4]
     
     svm_args = sys.argv[5:]
+    path = '--path' in svm_args
+    search = '--search' in svm_args
     
-    run_svms(c_begin, c_end, c_step, svm_args, output_basename)
+    if path:
+        svm_args.remove('--path')
+    if search:
+        svm_args.remove('--search')
+    
+    run_svms(c_begin, c_end, c_step, svm_args, output_basename, path, search)
 
-def run_svms(c_begin, c_end, c_step, svm_args, output_basename):
+def run_svms(c_begin, c_end, c_step, svm_args, output_basename, path=False, 
+             search=False):
+    '''
+    Cross-validates an SVM for each c in the range. If svm_args only ask for
+    cross-validation of a precomputed kernel file (-t 4 -v N FILE), the SVMs
+    are trained in this process by svm_backend, reading the kernel once,
+    when scikit-learn or libsvm's bindings can be imported. Otherwise
+    svm-train is run for each c. With path, the precomputed kernel's SVMs
+    are solved along the regularization path instead, each c warm-started
+    from the last (see svm_backend.regularization_path). With search, only
+    the c values chosen by svm_backend.adaptive_c_search between c_begin
+    and c_end are cross-validated, and c_step is ignored.
+    '''
     accuracies = []
     c_values = np.arange(c_begin, c_end, c_step)
-    for c in c_values:
-        output = run_svmtrain(svm_args, c)
-        accuracy = find_cv_accuracy(output)
+    precomputed = parse_precomputed_svm_args(svm_args)
+    
+    if path and search:
+        log.warning('--path and --search cannot be combined. Searching.')
+        path = False
+    
+    if path and not precomputed:
+        log.warning('--path needs a precomputed kernel (-t 4 -v N FILE). '
+                    'Running svm-train instead.')
+        path = False
+    
+    if precomputed and not path:
+        try:
+            svm_backend.find_backend()
+        except ImportError, e:
+            log.warning('%s. Running svm-train instead.' % e)
+            precomputed = None
+    
+    if precomputed:
+        folds, kernel_filename = precomputed
+        labels, kernel = svm_backend.read_gram_matrix(kernel_filename)
+        fold_ids = svm_backend.kernel_folds(labels, folds)
+    
+    def cross_validate(c):
+        if precomputed:
+            return svm_backend.cross_validation_accuracy(kernel, labels, c, 
+                                                         fold_ids=fold_ids)
+        else:
+            return find_cv_accuracy(run_svmtrain(svm_args, c))
+    
+    if path:
+        known_accuracies, iterations = svm_backend.regularization_path(kernel, labels, 
+                                                                       c_values, 
+                                                                       fold_ids=fold_ids)
+        print '%i solver iterations along the path' % iterations
+    elif search:
+        scores = svm_backend.adaptive_c_search(cross_validate, c_begin, c_end)[2]
+        c_values = np.array(sorted(scores))
+        known_accuracies = [scores[c] for c in c_values]
+        print '%i values of c searched' % len(c_values)
+    
+    for i, c in enumerate(c_values):
+        if path or search:
+            accuracy = known_accuracies[i]
+        else:
+            accuracy = cross_validate(c)
+        
         accuracies.append(accuracy)
         print 'accuracy = %.2f when c = %.3f' % (accuracy, c)
     
@@ -53,6 +117,23 @@ def run_svms(c_begin, c_end, c_step, svm_args, output_basename):
     
     return max_c, max_accuracy
 
+def parse_precomputed_svm_args(svm_args):
+    '''
+    Returns the number of folds and the kernel file if the svm-train
+    arguments only cross-validate a precomputed kernel, or None.
+    
+    >>> parse_precomputed_svm_args(['-t', '4', '-v', '5', 'words.train'])
+    (5, 'words.train')
+    >>> parse_precomputed_svm_args(['-k', 'openkernel', '-K', 'a.kar', '-v', '5', 'a.train'])
+    '''
+    options = dict(zip(svm_args[:-1:2], svm_args[1:-1:2]))
+    
+    if len(svm_args) % 2 == 1 and sorted(options) == ['-t', '-v'] and \
+            options['-t'] == '4' and options['-v'].isdigit():
+        return int(options['-v']), svm_args[-1]
+    
+    return None
+
 def run_svmtrain(svm_args, c):
     '''
     Runs svm-train with all the specified arguments and c. Returns the output
@@ -141,4 +222,8 @@ def save_accuracies(c_values, accuracies, basename):
     output.close()
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        import doctest
+        doctest.testmod(verbose=False)
+    else:
+        main()